@@ -0,0 +1,240 @@
+""" Batch conversion of a DICOM archive into resampled volumes
+Every series found under the root is loaded, resampled and saved by a pool of processes. Each folder
+is split into its stacks by the worker converting it, see crawler.split_series: a folder mixing several
+series or stacks gives one volume per stack, named <name>_stack<k>.
+A manifest records status, timings and checksums per stack, so that an interrupted run
+resumes where it stopped. Nothing is prompted, the conversion runs headless.
+
+Outputs, for each series:
+    <out_dir>/<name>.npy: resampled volume, yxz
+    <out_dir>/<name>_info.npz: origin, spacing, ori_spacing, direction, vol_shape, vol_zoomed_shape, age, sex
+
+Usage:
+    python batch_convert.py /path/to/archive /path/to/out_dir --workers 32
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+import crawler
+import image
+import main
+
+DTYPES = dict(int16=np.int16, float32=np.float32)
+
+
+class _HashWriter(object):
+    """
+    File wrapper computing the md5 of what is written, so that the checksum costs no extra read
+    """
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
+
+
+def _save_atomic(path, save_func, *args):
+    """
+    Save into a temporary file renamed once complete
+    :return: md5 of the file
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        writer = _HashWriter(f)
+        save_func(writer, *args)
+    os.rename(tmp_path, path)
+    return writer.md5.hexdigest()
+
+
+def series_names(series_list, root):
+    """
+    Distinct names of the outputs of the folders of crawler.crawl, the uid of each series or else its path
+    relative to root. A uid found in several folders gets the relative path appended.
+    :return: list of names, one per series
+    """
+    paths = [os.path.relpath(series['path'], root).replace(os.sep, '_') for series in series_list]
+    names = [series['series_uid'] or path for series, path in zip(series_list, paths)]
+    counts = Counter(names)
+    return [name + '_' + path if counts[name] > 1 else name for name, path in zip(names, paths)]
+
+
+def _new_record(name, path):
+    return dict(name=name, path=path, status='failed', timings=dict(), checksums=dict(), slice_check=None,
+                error=None)
+
+
+def convert_series(series, name, out_dir, backend='sitk', dtype='int16'):
+    """
+    Load, resample and save one series
+    :return: manifest record, dict(name, path, status, timings, checksums, slice_check, error), slice_check being
+             the report of main.loadDicom on duplicated, missing or mixed slices
+    """
+    record = _new_record(name, series['path'])
+    try:
+        t = time.time()
+        image_dict = main.loadDicom(series, backend=backend, dtype=DTYPES[dtype])
+        record['timings']['load'] = time.time() - t
+        if image_dict is False:
+            record['error'] = 'no dicom slice'
+            return record
+        record['slice_check'] = image_dict['slice_check']
+
+        t = time.time()
+        vol, spacing = image.interpolation(image_dict['array'], image_dict['spacing'])
+        record['timings']['resample'] = time.time() - t
+
+        t = time.time()
+        record['checksums']['volume'] = _save_atomic(os.path.join(out_dir, name + '.npy'), np.save, vol)
+        info = dict(origin=image_dict['origin'], spacing=spacing, ori_spacing=image_dict['spacing'],
+                    direction=image_dict['direction'], vol_shape=image_dict['array'].shape,
+                    vol_zoomed_shape=vol.shape, age=image_dict['age'], sex=image_dict['sex'])
+        buf = io.BytesIO()
+        np.savez(buf, **info)
+        record['checksums']['info'] = _save_atomic(os.path.join(out_dir, name + '_info.npz'),
+                                                   lambda f: f.write(buf.getvalue()))
+        record['timings']['save'] = time.time() - t
+        record['status'] = 'done'
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    return record
+
+
+def convert_folder(series, name, out_dir, backend='sitk', dtype='int16', finished=()):
+    """
+    Split a folder into its stacks and convert each of them, so that the header pass runs in the worker.
+    A folder of one stack is saved as name, the stacks of a folder mixing several as name_stack<k>.
+    :param series: dict(path, series_uid, ...) of crawler.crawl
+    :param finished: names of the stacks to skip, done or failed in a previous run
+    :return: manifest records of convert_series, with the folder name and its number of stacks. A folder
+             whose headers cannot be split gives one failed record
+    """
+    try:
+        stacks = crawler.split_series(series)
+    except Exception as e:
+        record = _new_record(name, series['path'])
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        stacks, records = [], [record]
+    else:
+        # a folder without any slice is reported by convert_series
+        records = [] if stacks or name in finished else [convert_series(series, name, out_dir, backend, dtype)]
+    for stack in stacks:
+        stack_name = name if len(stacks) == 1 else '%s_stack%d' % (name, stack['stack'])
+        if stack_name not in finished:
+            records.append(convert_series(stack, stack_name, out_dir, backend, dtype))
+    for record in records:
+        record.update(folder=name, num_stacks=max(len(stacks), 1))
+    return records
+
+
+def _convert_job(job):
+    return convert_folder(*job)
+
+
+def _is_finished(record, out_dir, retry_failed):
+    if record['status'] == 'done':
+        return os.path.isfile(os.path.join(out_dir, record['name'] + '.npy'))
+    return not retry_failed
+
+
+def read_manifest(manifest_path):
+    """
+    Read the manifest, the last record of a series wins
+    :return: dict of name -> record
+    """
+    records = dict()
+    if not os.path.isfile(manifest_path):
+        return records
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line might be truncated by an interruption
+                continue
+            records[record['name']] = record
+    return records
+
+
+def batch_convert(root, out_dir, manifest_path=None, num_workers=None, backend='sitk', dtype='int16',
+                  crawl_cache=None, retry_failed=False):
+    """
+    Convert every series under root, one job per folder, skipping the stacks already done according to the
+    manifest
+    :param root: root folder of the archive
+    :param out_dir: folder to save the outputs
+    :param manifest_path: json lines manifest, <out_dir>/manifest.jsonl if None
+    :param num_workers: number of processes, cpu count if None
+    :param backend: backend of main.loadDicom
+    :param dtype: 'int16' or 'float32'
+    :param crawl_cache: cache of crawler.crawl
+    :param retry_failed: also convert the series which failed in a previous run
+    :return: list of the records of this run
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if manifest_path is None:
+        manifest_path = os.path.join(out_dir, 'manifest.jsonl')
+
+    folders = dict()
+    for record in read_manifest(manifest_path).values():
+        folders.setdefault(record.get('folder', record['name']), []).append(record)
+    series_list = crawler.crawl(root, cache_path=crawl_cache)
+    jobs = []
+    for series, name in zip(series_list, series_names(series_list, root)):
+        previous = folders.get(name, [])
+        finished = set(record['name'] for record in previous if _is_finished(record, out_dir, retry_failed))
+        if previous and len(finished) >= max(record.get('num_stacks', 1) for record in previous):
+            continue
+        jobs.append((series, name, out_dir, backend, dtype, finished))
+    print('%d folders to convert' % len(jobs))
+
+    records = []
+    t = time.time()
+    pool = Pool(num_workers or cpu_count(), maxtasksperchild=16)
+    try:
+        with open(manifest_path, 'a') as manifest:
+            for num_folders, folder_records in enumerate(pool.imap_unordered(_convert_job, jobs), 1):
+                for record in folder_records:
+                    manifest.write(json.dumps(record) + '\n')
+                    manifest.flush()
+                    records.append(record)
+                    elapsed = time.time() - t
+                    print('[%d/%d] %s %s, %.1f patients/hour' % (num_folders, len(jobs), record['name'],
+                                                                record['status'], 3600. * num_folders / elapsed))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    num_done = sum(record['status'] == 'done' for record in records)
+    print('converted %d series, %d failed, in %.1fs' % (num_done, len(records) - num_done, time.time() - t))
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a DICOM archive into resampled volumes')
+    parser.add_argument('root', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--manifest', type=str, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', type=str, default='sitk', choices=['sitk', 'threads'])
+    parser.add_argument('--dtype', type=str, default='int16', choices=sorted(DTYPES))
+    parser.add_argument('--crawl_cache', type=str, default=None)
+    parser.add_argument('--retry_failed', action='store_true')
+    args = parser.parse_args()
+
+    batch_convert(args.root, args.out_dir, args.manifest, args.workers, args.backend, args.dtype,
+                  args.crawl_cache, args.retry_failed)
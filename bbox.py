@@ -1,93 +1,332 @@
 """ Implementation of helpers to deal with bounding boxes
 bbox: [min_dim0, min_dim1, min_dim2, max_dim0, max_dim1, max_dim2]
 center: [dim0, dim1, dim2]
+Most helpers also take arrays of boxes (N, 6) and centers (N, 3)
 """
 
 import numpy as np
 
+import profiler
 
-def regularize(x):
+
+def regularize(x, dtype=np.int32):
     """
     Regularize the array by rounding and casting into integer
+    :param dtype: integer dtype, int32 so that coordinates of large volumes do not wrap around
     """
-    return np.round(x).astype(np.int16)
+    return np.round(x).astype(dtype)
 
 
 def bbox2center(bbox):
-    bbox = np.array(bbox, dtype=np.float32)
-    center = 0.5 * np.array([(bbox[0] + bbox[3]), (bbox[1] + bbox[4]), (bbox[2] + bbox[5])])
-    return regularize(center)
+    """
+    Converting given bounding boxes into centers
+    :param bbox: (6,) or (N, 6)
+    :return: (3,) or (N, 3) centers
+    """
+    bbox = np.asarray(bbox, dtype=np.float32)
+    return regularize(0.5 * (bbox[..., 0:3] + bbox[..., 3:6]))
 
 
 def center2bbox(center, diameter):
     """
-    Converting given center into bounding box
-    :param center: (3,)
-    :param diameter: () or (3,)
-    :return: (6,) bounding box
+    Converting given centers into bounding boxes
+    :param center: (3,) or (N, 3)
+    :param diameter: () or (3,) for a single center, (), (N,) or (N, 3) for N centers
+    :return: (6,) or (N, 6) bounding boxes
     """
-    diameter = np.array(diameter)
-    if len(diameter.shape) == 0:
-        diameter = np.repeat(diameter, 3)
-
     center = regularize(center)
-    left = np.floor(diameter / 2).astype(np.int16)
-    right = np.ceil(diameter / 2).astype(np.int16)
+    diameter = np.asarray(diameter, dtype=np.float64)
+    if diameter.ndim < center.ndim:
+        # isotropic diameters
+        diameter = diameter[..., np.newaxis]
 
-    bbox = np.array([center[0] - left[0], center[1] - left[1], center[2] - left[2],
-                     center[0] + right[0], center[1] + right[1], center[2] + right[2]])
+    left = regularize(np.floor(diameter / 2))
+    right = regularize(np.ceil(diameter / 2))
 
-    return bbox
+    return np.concatenate(np.broadcast_arrays(center - left, center + right), axis=-1)
 
 
 def in_bbox(center, bbox):
-    return bbox[0] <= center[0] <= bbox[3] \
-           and bbox[1] <= center[1] <= bbox[4] \
-           and bbox[2] <= center[2] <= bbox[5]
+    """
+    Whether centers are inside bounding boxes, bounds included. Shapes are broadcast
+    :param center: (..., 3)
+    :param bbox: (..., 6)
+    :return: (...) bool
+    """
+    center = np.asarray(center)
+    bbox = np.asarray(bbox)
+    return np.all((bbox[..., 0:3] <= center) & (center <= bbox[..., 3:6]), axis=-1)
+
+
+def points_in_bboxes(points, bboxes):
+    """
+    Point-in-box matrix
+    :param points: (P, 3)
+    :param bboxes: (N, 6)
+    :return: (P, N) bool, True if point p is inside box n, bounds included
+    """
+    points = np.reshape(points, (-1, 3))
+    bboxes = np.reshape(bboxes, (-1, 6))
+    return in_bbox(points[:, np.newaxis, :], bboxes[np.newaxis, :, :])
+
+
+def bbox_volume(bboxes):
+    """
+    Volume of bounding boxes, max - min along each axis as the size of create_subvol
+    :param bboxes: (..., 6)
+    :return: (...)
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    return np.prod(np.maximum(bboxes[..., 3:6] - bboxes[..., 0:3], 0), axis=-1)
 
 
+def iou(bboxes_a, bboxes_b):
+    """
+    Pairwise 3D intersection over union
+    :param bboxes_a: (N, 6)
+    :param bboxes_b: (M, 6)
+    :return: (N, M)
+    """
+    bboxes_a = np.reshape(bboxes_a, (-1, 6)).astype(np.float64)
+    bboxes_b = np.reshape(bboxes_b, (-1, 6)).astype(np.float64)
+    inter_min = np.maximum(bboxes_a[:, np.newaxis, 0:3], bboxes_b[np.newaxis, :, 0:3])
+    inter_max = np.minimum(bboxes_a[:, np.newaxis, 3:6], bboxes_b[np.newaxis, :, 3:6])
+    inter = np.prod(np.maximum(inter_max - inter_min, 0), axis=-1)
+    union = bbox_volume(bboxes_a)[:, np.newaxis] + bbox_volume(bboxes_b)[np.newaxis, :] - inter
+    return inter / np.maximum(union, np.finfo(np.float64).tiny)
+
+
+NMS_BLOCK = 256  # boxes of the first block of nms, the blocks double in size
+MAX_PAIRS = 1 << 20  # candidate pairs generated at once by _overlap_pairs
+
+
+def _expand(counts):
+    """
+    For ranges of lengths counts, the range of each element and its position in its range
+    """
+    owner = np.repeat(np.arange(len(counts)), counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return owner, np.arange(len(owner)) - starts[owner]
+
+
+def _shrink(bboxes, ratio):
+    """
+    Boxes shrunk by ratio of their extent on each side
+    """
+    margins = ratio * (bboxes[:, 3:6] - bboxes[:, 0:3])
+    return np.concatenate([bboxes[:, 0:3] + margins, bboxes[:, 3:6] - margins], axis=1)
+
+
+def _grid_cells(bboxes, cell):
+    """
+    Cells of a grid of size cell covered by each box
+    :return: box of each cell, (K, 3) integer coordinates of the cells
+    """
+    low = np.floor(bboxes[:, 0:3] / cell).astype(np.int64)
+    high = np.maximum(np.ceil(bboxes[:, 3:6] / cell).astype(np.int64) - 1, low)
+    sizes = high - low + 1
+    owner, k = _expand(np.prod(sizes, axis=1))
+    sizes = sizes[owner]
+    delta = np.stack([k // (sizes[:, 1] * sizes[:, 2]), (k // sizes[:, 2]) % sizes[:, 1], k % sizes[:, 2]], axis=1)
+    return owner, low[owner] + delta
+
+
+def _cell_keys(coords, origin, extent):
+    coords = coords - origin
+    return (coords[:, 0] * extent[1] + coords[:, 1]) * extent[2] + coords[:, 2]
+
+
+def _overlap_pairs(bboxes_a, bboxes_b, iou_threshold, max_pairs=MAX_PAIRS):
+    """
+    Pairs of boxes of a and b overlapping by more than iou_threshold, found through a grid hashing the boxes
+    of b: only the boxes of b sharing a cell with a box of a are compared with it, i.e. the boxes are pruned
+    along the three axes. A pair sharing several cells is only compared in the cell of the min corner of
+    its intersection. The boxes of a are processed in chunks of about max_pairs candidate pairs.
+    An iou above t requires an overlap above t times the extent of both boxes along each axis, so the boxes
+    are hashed and intersected shrunk by about t / 2 of their extent on each side.
+    :param bboxes_a: (N, 6) float64
+    :param bboxes_b: (M, 6) float64, None for the pairs i < j within a
+    :return: indices i into a and j into b of the pairs
+    """
+    self_pairs = bboxes_b is None
+    if self_pairs:
+        bboxes_b = bboxes_a
+    empty = np.zeros(0, dtype=np.int64)
+    if len(bboxes_a) == 0 or len(bboxes_b) == 0:
+        return empty, empty
+
+    # cores of the boxes, still intersecting for any pair above the threshold
+    shrink = 0.49 * min(max(float(iou_threshold), 0.), 1.)
+    cores_a, cores_b = _shrink(bboxes_a, shrink), _shrink(bboxes_b, shrink)
+    # cells of about the size of the boxes, each box covers a few cells
+    extents = np.max(cores_b[:, 3:6] - cores_b[:, 0:3], axis=1)
+    cell = 2 * float(np.median(extents))
+    if not cell > 0:
+        cell = max(float(np.max(extents)), 1.)
+
+    owner_b, coords_b = _grid_cells(cores_b, cell)
+    owner_a, coords_a = _grid_cells(cores_a, cell)
+    origin = np.minimum(coords_a.min(axis=0), coords_b.min(axis=0))
+    extent = np.maximum(coords_a.max(axis=0), coords_b.max(axis=0)) - origin + 1
+    # registrations of b sorted by cell, then by box
+    keys_b = _cell_keys(coords_b, origin, extent) * len(bboxes_b) + owner_b
+    sort = np.argsort(keys_b)
+    keys_b, owner_b = keys_b[sort], owner_b[sort]
+    keys_a = _cell_keys(coords_a, origin, extent) * len(bboxes_b)
+    # for the pairs within a, only the boxes j > i of the cell
+    starts = np.searchsorted(keys_b, keys_a + owner_a + 1 if self_pairs else keys_a, side='left')
+    counts = np.searchsorted(keys_b, keys_a + len(bboxes_b), side='left') - starts
+    cum_counts = np.concatenate([[0], np.cumsum(counts)])
+    volumes_a, volumes_b = bbox_volume(bboxes_a), bbox_volume(bboxes_b)
+    columns_a, columns_b = [np.ascontiguousarray(cores_a[:, dim]) for dim in range(6)], \
+        [np.ascontiguousarray(cores_b[:, dim]) for dim in range(6)]
+
+    first, second = [], []
+    start = 0
+    while start < len(keys_a):
+        # the chunk takes at least one cell of a, then as many as fit in max_pairs
+        stop = max(start + 1, np.searchsorted(cum_counts, cum_counts[start] + max_pairs, side='right') - 1)
+        stop = min(stop, len(keys_a))
+        rows, k = _expand(counts[start:stop])
+        rows += start
+        i, j, rows = owner_a[rows], owner_b[starts[rows] + k], rows
+        # one axis at a time, each dropping the pairs of cores not intersecting or not compared in this cell
+        for dim in range(3):
+            inter_min = np.maximum(columns_a[dim][i], columns_b[dim][j])
+            inter_max = np.minimum(columns_a[dim + 3][i], columns_b[dim + 3][j])
+            mask = (inter_max > inter_min) & (np.floor(inter_min / cell) == coords_a[rows, dim])
+            i, j, rows = i[mask], j[mask], rows[mask]
+        boxes_a, boxes_b = bboxes_a[i], bboxes_b[j]
+        inter = np.prod(np.minimum(boxes_a[:, 3:6], boxes_b[:, 3:6]) - np.maximum(boxes_a[:, 0:3], boxes_b[:, 0:3]),
+                        axis=1)
+        overlap = inter / np.maximum(volumes_a[i] + volumes_b[j] - inter, np.finfo(np.float64).tiny)
+        mask = overlap > iou_threshold
+        first.append(i[mask])
+        second.append(j[mask])
+        start = stop
+    return np.concatenate(first + [empty]), np.concatenate(second + [empty])
+
+
+def _greedy(num, first, second):
+    """
+    Greedy suppression of boxes sorted by decreasing score, box first[k] suppressing box second[k] > first[k]
+    :return: bool mask of the kept boxes
+    """
+    suppressed = np.zeros(num, dtype=bool)
+    if len(first) == 0:
+        return ~suppressed
+    sort = np.argsort(first, kind='mergesort')
+    first, second = first[sort], second[sort]
+    sources, offsets = np.unique(first, return_index=True)
+    offsets = np.concatenate([offsets, [len(first)]])
+    # only the boxes suppressing others are visited, the status of a box is final once the higher ones are
+    for k, i in enumerate(sources):
+        if not suppressed[i]:
+            suppressed[second[offsets[k]:offsets[k + 1]]] = True
+    return ~suppressed
+
+
+@profiler.timed('nms')
+def nms(bboxes, scores, iou_threshold=0.1, block_size=NMS_BLOCK):
+    """
+    3D non-maximum suppression
+    Boxes are visited by decreasing score, each kept box suppresses the boxes overlapping it by more
+    than iou_threshold. The boxes are resolved by blocks of decreasing score, of doubling size: the
+    suppression within a block is exact and greedy, then the kept boxes of the block suppress the
+    remaining ones at once. The boxes suppressed by a block, e.g. most of a dense cluster of
+    detections, are never compared again. Overlaps are only computed for boxes sharing cells of a grid.
+    :param bboxes: (N, 6)
+    :param scores: (N,)
+    :param iou_threshold: boxes with a higher iou with a kept box are suppressed
+    :param block_size: size of the first block
+    :return: indices of the kept boxes, by decreasing score
+    """
+    bboxes = np.reshape(bboxes, (-1, 6)).astype(np.float64)
+    alive = np.argsort(-np.asarray(scores), kind='mergesort')
+    keep = []
+    while len(alive):
+        block, alive = alive[:block_size], alive[block_size:]
+        kept = block[_greedy(len(block), *_overlap_pairs(bboxes[block], None, iou_threshold))]
+        keep.append(kept)
+        if len(alive):
+            suppressed = np.unique(_overlap_pairs(bboxes[kept], bboxes[alive], iou_threshold)[1])
+            # once a block suppresses few of the remaining boxes, they are sparse and resolved at once
+            block_size = block_size * 2 if 2 * len(suppressed) > len(alive) else len(alive)
+            alive = np.delete(alive, suppressed)
+    return np.concatenate(keep + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+
+
+def _valid_region(shape, bbox):
+    """
+    Part of a bounding box inside a volume
+    :return: valid_min, valid_max in the volume, and the offset of valid_min in the bounding box
+    """
+    valid_min = np.maximum(bbox[0:3], 0)
+    valid_max = np.maximum(np.minimum(bbox[3:6], shape[0:3]), valid_min)
+    return valid_min, valid_max, valid_min - bbox[0:3]
+
+
+@profiler.timed('create_subvol')
 def create_subvol(vol, bbox, padding_value=-1024):
     """
     Create a sub-volume of a given volume according to bbox
     Similar to np.pad, but faster
     :param vol: given volume, only required to support [] operator. Thus, available for np.load or h5py.dataset
     :param bbox: bounding box to crop
-    :param padding_value: value to pad
-    :return: a sub-volume
+    :param padding_value: value to pad, cast to the dtype of vol
+    :return: a sub-volume of the same dtype as vol, a view of vol if no padding is needed and vol supports views
     """
     bbox = regularize(bbox)
-    valid_min = np.max([[0, 0, 0], bbox[0:3]], axis=0)
-    valid_max = np.min([vol.shape, bbox[3:6]], axis=0)
-    # print(valid_min, valid_max)
+    valid_min, valid_max, offset = _valid_region(vol.shape, bbox)
+    subvol = vol[valid_min[0]:valid_max[0], valid_min[1]:valid_max[1], valid_min[2]:valid_max[2]]
+    if np.array_equal(subvol.shape, bbox[3:6] - bbox[0:3]):
+        return subvol
 
-    padding_min = np.max([[0, 0, 0], -bbox[0:3]], axis=0)
-    padding_max = np.max([[0, 0, 0], bbox[3:6] - vol.shape], axis=0)
-    # print(padding_min, padding_max)
+    # padded once, instead of concatenating along each axis
+    out = np.full(bbox[3:6] - bbox[0:3], padding_value, dtype=subvol.dtype)
+    end = offset + subvol.shape
+    out[offset[0]:end[0], offset[1]:end[1], offset[2]:end[2]] = subvol
+    return out
 
-    # t = time.time()
-    subvol = vol[valid_min[0]:valid_max[0], valid_min[1]:valid_max[1], valid_min[2]:valid_max[2]]
-    # print(time.time()-t)
 
-    for dim in range(subvol.ndim):
-        if padding_min[dim] == 0 and padding_max[dim] == 0:
-            continue
+@profiler.timed('create_subvols')
+def create_subvols(vol, bboxes, padding_value=-1024, out=None, copy=None):
+    """
+    Create the sub-volumes of a given volume for a batch of bounding boxes of the same size.
+    The output is allocated once and filled with padding_value, only the valid region of each box is copied.
+    The boxes are read in the order of the storage of vol, which keeps the reads of a memory-mapped
+    array or of a h5py dataset sequential.
+    :param vol: given volume, only required to support [] operator. Thus, available for np.load or h5py.dataset
+    :param bboxes: (N, 6) bounding boxes to crop, all of the same size
+    :param padding_value: value to pad, cast to the dtype of vol
+    :param out: optional (N, d0, d1, d2) array to write into
+    :param copy: optional function(src, dst) writing the valid region src of vol into dst, e.g. to scale it
+                 on the fly. By default, dst[...] = src
+    :return: (N, d0, d1, d2) sub-volumes, in the order of bboxes
+    """
+    bboxes = regularize(np.reshape(bboxes, (-1, 6)))
+    sizes = bboxes[:, 3:6] - bboxes[:, 0:3]
+    if len(bboxes) and np.any(sizes != sizes[0]):
+        raise ValueError('all the bounding boxes must have the same size')
+
+    shape = (len(bboxes),) + (tuple(sizes[0]) if len(bboxes) else (0, 0, 0))
+    if out is None:
+        out = np.full(shape, padding_value, dtype=vol.dtype)
+    else:
+        if out.shape != shape:
+            raise ValueError('out has shape %s, expected %s' % (out.shape, shape))
+        out[...] = padding_value
 
-        padding_shape = list(subvol.shape)
-        padding_shape[dim] = padding_min[dim]
-        padding_left = np.zeros(shape=padding_shape,
-                                dtype=subvol.dtype) + padding_value
-        padding_shape[dim] = padding_max[dim]
-        padding_right = np.zeros(shape=padding_shape,
-                                 dtype=subvol.dtype) + padding_value
-
-        subvol = np.concatenate((padding_left, subvol, padding_right), axis=dim)
-
-    # pad_width = list()
-    # for dim in range(3):
-    #     pad_width.append((padding_min[dim], padding_max[dim]))
-    #
-    # # print pad_width
-    #
-    # subvol = np.pad(subvol, pad_width, 'constant', constant_values=padding_value)
-
-    return subvol
+    # sorted by position along dim0, then dim1 and dim2, i.e. the row-major order of the storage
+    for i in np.lexsort((bboxes[:, 2], bboxes[:, 1], bboxes[:, 0])):
+        valid_min, valid_max, offset = _valid_region(vol.shape, bboxes[i])
+        if np.any(valid_max <= valid_min):
+            continue
+        end = offset + valid_max - valid_min
+        src = vol[valid_min[0]:valid_max[0], valid_min[1]:valid_max[1], valid_min[2]:valid_max[2]]
+        dst = out[i, offset[0]:end[0], offset[1]:end[1], offset[2]:end[2]]
+        if copy is None:
+            dst[...] = src
+        else:
+            copy(src, dst)
+    return out
@@ -0,0 +1,374 @@
+""" Benchmarks of the hot paths
+Every measure runs in a fresh process, so that the peak RSS of one case does not leak into the next.
+
+The suite generates synthetic volumes and fake DICOM series, times every hot path at several sizes
+and compares wall time and peak memory against a stored baseline. benchmark_baseline.json is the
+baseline of every case at every size, measured on a single cpu: save a new one on another machine.
+
+Usage:
+    python benchmark.py load_memory --dicom_dir /path/to/series
+    python benchmark.py resample --shape 512 512 300 --spacing 0.7 0.7 1.25
+    python benchmark.py suite --save_baseline benchmark_baseline.json
+    python benchmark.py suite --baseline benchmark_baseline.json --sizes small medium
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+
+import numpy as np
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+# (backend, dtype) of loadDicom to compare, float64 is the former policy
+LOAD_CONFIGS = [('sitk', np.float64), ('sitk', np.float32), ('sitk', np.int16), ('threads', np.int16)]
+
+# (method, order, num_workers) of the resampling to compare, map_coordinates is the former image.interpolation
+RESAMPLE_CONFIGS = [('map_coordinates', 1, 1), ('separable', 1, 1), ('separable', 1, 4), ('separable', 3, 4)]
+
+# sizes of the suite, (rows, columns, slices), and spacing of the synthetic series
+SUITE_SIZES = OrderedDict([('small', (256, 256, 64)), ('medium', (512, 512, 128)), ('large', (512, 512, 300))])
+SUITE_SPACING = (0.7, 0.7, 1.25)
+SUITE_CASES = ['load_sitk', 'load_threads', 'resample', 'roi', 'window', 'viewer']
+SUITE_REPEAT = 3  # the fast cases are timed as the best of SUITE_REPEAT runs
+ROI_NUM_BOXES = 256
+ROI_SIZE = 48
+VIEWER_FRAMES = 30
+TOLERANCE = 0.2  # relative change of time or memory reported as a regression or a speedup
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def _target(queue, func, args):
+    queue.put(func(*args))
+
+
+def _run_in_process(func, *args):
+    """
+    Run func(*args) in a child process and return its result, which must be picklable
+    """
+    queue = Queue()
+    process = Process(target=_target, args=(queue, func, args))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise RuntimeError('%s failed in the child process' % func.__name__)
+    process.join()
+    return result
+
+
+def _load(dicom_dir, backend, dtype):
+    import main
+
+    t = time.time()
+    image_dict = main.loadDicom(dicom_dir, backend=backend, dtype=dtype, use_cache=False)
+    return dict(backend=backend, dtype=np.dtype(dtype).name, time=time.time() - t,
+                volume_mb=image_dict['array'].nbytes / 1024. ** 2, peak_rss_mb=peak_rss_mb())
+
+
+def bench_load_memory(dicom_dir, configs=LOAD_CONFIGS):
+    """
+    Peak RSS and wall time of loadDicom for each (backend, dtype)
+    :param dicom_dir: folder of a dicom series
+    :param configs: list of (backend, dtype)
+    :return: list of dict, one per config
+    """
+    return [_run_in_process(_load, dicom_dir, backend, dtype) for backend, dtype in configs]
+
+
+def synthetic_volume(shape, dtype=np.int16, seed=0):
+    """
+    Smooth random volume in a CT-like range of values
+    """
+    import scipy.ndimage as ndi
+
+    rng = np.random.RandomState(seed)
+    vol = np.empty(shape, dtype=dtype)
+    # smoothed slab by slab to keep the float64 temporaries small
+    for z in range(0, shape[2], 16):
+        noise = ndi.gaussian_filter(rng.rand(shape[0], shape[1], min(16, shape[2] - z)), 2)
+        vol[:, :, z:z + 16] = (noise - 0.5) * 8000 - 200
+    return vol
+
+
+def _resample(shape, spacing, new_spacing, method, order, num_workers):
+    import scipy.ndimage as ndi
+    import image
+
+    vol = synthetic_volume(shape)
+    rss_before = peak_rss_mb()
+    t = time.time()
+    if method == 'map_coordinates':
+        ndi.map_coordinates(vol, np.mgrid[0:shape[0]:(new_spacing[0] / spacing[0]),
+                                          0:shape[1]:(new_spacing[1] / spacing[1]),
+                                          0:shape[2]:(new_spacing[2] / spacing[2])], order=order, mode='nearest')
+    else:
+        image.interpolation(vol, spacing, new_spacing, order=order, num_workers=num_workers)
+    return dict(method=method, order=order, num_workers=num_workers, time=time.time() - t,
+                input_rss_mb=rss_before, peak_rss_mb=peak_rss_mb())
+
+
+def bench_resample(shape, spacing, new_spacing=None, configs=RESAMPLE_CONFIGS):
+    """
+    Peak RSS and wall time of the resampling of a synthetic int16 volume for each (method, order, num_workers)
+    :param shape: shape of the volume
+    :param spacing: spacing of the volume
+    :param new_spacing: target spacing, as image.interpolation if None
+    :param configs: list of (method, order, num_workers)
+    :return: list of dict, one per config
+    """
+    if new_spacing is None:
+        new_spacing = (spacing[0], spacing[1], max(spacing[0:2]))
+    return [_run_in_process(_resample, shape, spacing, new_spacing, method, order, num_workers)
+            for method, order, num_workers in configs]
+
+
+def make_dicom_series(dicom_dir, shape, spacing=SUITE_SPACING, seed=0, unsigned=True):
+    """
+    Write a fake CT series, the slices of synthetic_volume clipped to -1024, see series_volume
+    :param dicom_dir: folder of the series, created if needed
+    :param shape: (rows, columns, slices)
+    :param spacing: (row spacing, column spacing, slice spacing)
+    :param unsigned: store unsigned pixels (PixelRepresentation 0), the most common layout of CT, else signed
+    """
+    import pydicom
+    from pydicom.dataset import Dataset
+    from pydicom.uid import generate_uid
+    try:
+        from pydicom.dataset import FileMetaDataset
+    except ImportError:
+        FileMetaDataset = Dataset
+
+    if not os.path.isdir(dicom_dir):
+        os.makedirs(dicom_dir)
+    pixels = series_volume(shape, seed) + 1024
+    series_uid = generate_uid()
+    for z in range(shape[2]):
+        meta = FileMetaDataset()
+        meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'  # explicit VR little endian
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'  # CT image storage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds = Dataset()
+        ds.file_meta = meta
+        if int(pydicom.__version__.split('.')[0]) < 3:
+            ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Modality = 'CT'
+        ds.SeriesInstanceUID = series_uid
+        ds.PatientAge = '060Y'
+        ds.PatientSex = 'M'
+        ds.ImagePositionPatient = [-180., -180., -300. + z * spacing[2]]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [spacing[0], spacing[1]]
+        ds.SliceThickness = spacing[2]
+        ds.InstanceNumber = z + 1
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.Rows, ds.Columns = shape[0], shape[1]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.PixelRepresentation = 0 if unsigned else 1
+        ds.PixelData = pixels[:, :, z].astype(np.uint16 if unsigned else np.int16).tobytes()
+        file_name = os.path.join(dicom_dir, 'IM%05d.dcm' % z)
+        try:
+            ds.save_as(file_name, enforce_file_format=True)
+        except TypeError:
+            ds.save_as(file_name, write_like_original=False)
+
+
+def series_volume(shape, seed=0):
+    """
+    Volume of make_dicom_series, in HU
+    """
+    return np.maximum(synthetic_volume(shape, seed=seed), -1024)
+
+
+def _best_time(func, repeat=SUITE_REPEAT):
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        func()
+        times.append(time.time() - t)
+    return min(times)
+
+
+def _case(case, shape, dicom_dir):
+    """
+    Run one case of the suite
+    :return: dict(time, peak_rss_mb), time in seconds
+    """
+    if case.startswith('load_'):
+        import main
+
+        t = time.time()
+        # the series is given as an entry of crawler.crawl, the small ones being under its crawler.MIN_FILES.
+        # Every load reads the headers, without an index left by a previous case nor saved for the next one
+        image_dict = main.loadDicom(dict(path=dicom_dir), backend=case[len('load_'):], use_cache=False)
+        elapsed = time.time() - t
+        if not np.array_equal(image_dict['array'], series_volume(shape)):
+            raise ValueError('%s does not load the series of make_dicom_series' % case)
+        return dict(time=elapsed, peak_rss_mb=peak_rss_mb())
+
+    vol = synthetic_volume(shape)
+    if case == 'resample':
+        import image
+
+        elapsed = _best_time(lambda: image.interpolation(vol, SUITE_SPACING), repeat=1)
+    elif case == 'roi':
+        import bbox as B
+
+        rng = np.random.RandomState(0)
+        bboxes = B.center2bbox(rng.uniform(0, 1, (ROI_NUM_BOXES, 3)) * shape, ROI_SIZE)
+        elapsed = _best_time(lambda: B.create_subvols(vol, bboxes))
+    elif case == 'window':
+        import intensity
+
+        out = np.empty(vol.shape, dtype=np.float32)
+        elapsed = _best_time(lambda: intensity.normalize(vol, out=out))
+    elif case == 'viewer':
+        elapsed = _viewer_frame_time(vol)
+    else:
+        raise ValueError('unknown case %s' % case)
+    return dict(time=elapsed, peak_rss_mb=peak_rss_mb())
+
+
+def _viewer_frame_time(vol):
+    """
+    Median redraw time of view_scan scrolling through VIEWER_FRAMES slices, on the Agg backend
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.backend_bases import KeyEvent
+    import viewer
+
+    frame_timer = viewer.FrameTimer()
+
+    def show(*args, **kwargs):
+        # replaces the event loop: draw once, then scroll as if the user pressed the key
+        fig = plt.gcf()
+        fig.canvas.draw()
+        for _ in range(VIEWER_FRAMES):
+            fig.canvas.callbacks.process('key_press_event', KeyEvent('key_press_event', fig.canvas, 'w'))
+
+    plt.show = show
+    viewer.view_scan(vol, start_slice=0, frame_timer=frame_timer, prefetch=0)
+    return float(np.median(frame_timer.times))
+
+
+def run_suite(sizes=tuple(SUITE_SIZES), cases=SUITE_CASES, work_dir=None):
+    """
+    Run the cases at the sizes, each in a fresh process
+    :param sizes: names of SUITE_SIZES
+    :param cases: names of SUITE_CASES
+    :param work_dir: folder of the fake DICOM series, a temporary folder removed at the end if None
+    :return: OrderedDict of '<case>/<size>' -> dict(time, peak_rss_mb)
+    """
+    tmp_dir = tempfile.mkdtemp() if work_dir is None else None
+    work_dir = work_dir or tmp_dir
+    results = OrderedDict()
+    try:
+        for size in sizes:
+            shape = SUITE_SIZES[size]
+            dicom_dir = os.path.join(work_dir, '%s_%dx%dx%d' % ((size,) + shape))
+            if any(case.startswith('load_') for case in cases) and not os.path.isdir(dicom_dir):
+                make_dicom_series(dicom_dir, shape)
+            for case in cases:
+                results['%s/%s' % (case, size)] = _run_in_process(_case, case, shape, dicom_dir)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare results of run_suite against a baseline
+    :return: list of lines of the report, ending with the number of regressions
+    """
+    lines = ['%-22s %10s %10s %8s %12s %12s %8s' % ('case', 'time(s)', 'base(s)', 'ratio', 'peak(MB)', 'base(MB)',
+                                                    'ratio')]
+    num_regressions = 0
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            lines.append('%-22s %10.3f %10s %8s %12.1f %12s %8s' % (key, res['time'], '-', '-', res['peak_rss_mb'],
+                                                                     '-', '-'))
+            continue
+        time_ratio = res['time'] / max(base['time'], 1e-9)
+        rss_ratio = res['peak_rss_mb'] / max(base['peak_rss_mb'], 1e-9)
+        flags = []
+        for name, ratio in (('time', time_ratio), ('memory', rss_ratio)):
+            if ratio > 1 + tolerance:
+                flags.append('%s regression' % name)
+            elif ratio < 1 - tolerance:
+                flags.append('%s speedup' % name)
+        num_regressions += sum('regression' in flag for flag in flags)
+        lines.append('%-22s %10.3f %10.3f %8.2f %12.1f %12.1f %8.2f  %s' % (
+            key, res['time'], base['time'], time_ratio, res['peak_rss_mb'], base['peak_rss_mb'], rss_ratio,
+            ', '.join(flags)))
+    lines.append('%d regression(s) beyond %d%%' % (num_regressions, 100 * tolerance))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the hot paths')
+    parser.add_argument('bench', choices=['load_memory', 'resample', 'suite'])
+    parser.add_argument('--dicom_dir', type=str, default=None)
+    parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 300])
+    parser.add_argument('--spacing', type=float, nargs=3, default=[0.7, 0.7, 1.25])
+    parser.add_argument('--new_spacing', type=float, nargs=3, default=None)
+    parser.add_argument('--sizes', type=str, nargs='+', default=list(SUITE_SIZES), choices=list(SUITE_SIZES))
+    parser.add_argument('--cases', type=str, nargs='+', default=SUITE_CASES, choices=SUITE_CASES)
+    parser.add_argument('--work_dir', type=str, default=None, help='folder of the fake DICOM series, kept')
+    parser.add_argument('--baseline', type=str, default=None, help='json baseline to compare against')
+    parser.add_argument('--save_baseline', type=str, default=None, help='save the results as a json baseline')
+    args = parser.parse_args()
+
+    if args.bench == 'load_memory':
+        if args.dicom_dir is None:
+            parser.error('load_memory requires --dicom_dir')
+        print('%-8s %-8s %10s %10s %12s' % ('backend', 'dtype', 'time(s)', 'volume(MB)', 'peak RSS(MB)'))
+        for res in bench_load_memory(args.dicom_dir):
+            print('%-8s %-8s %10.2f %10.1f %12.1f' % (res['backend'], res['dtype'], res['time'],
+                                                     res['volume_mb'], res['peak_rss_mb']))
+
+    if args.bench == 'resample':
+        print('%-16s %6s %8s %10s %12s %12s' % ('method', 'order', 'workers', 'time(s)', 'input(MB)', 'peak RSS(MB)'))
+        for res in bench_resample(args.shape, args.spacing, args.new_spacing):
+            print('%-16s %6d %8d %10.2f %12.1f %12.1f' % (res['method'], res['order'], res['num_workers'], res['time'],
+                                                         res['input_rss_mb'], res['peak_rss_mb']))
+
+    if args.bench == 'suite':
+        results = run_suite(args.sizes, args.cases, args.work_dir)
+        baseline = dict()
+        if args.baseline is not None:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+        print('\n'.join(compare(results, baseline)))
+        if args.save_baseline is not None:
+            with open(args.save_baseline, 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,180 @@
+""" Implementation of a crawler indexing every DICOM series under a root folder
+The root is walked once with os.scandir, subtrees are walked in parallel. The result can be
+cached to disk, a later crawl then only lists the folders whose mtime changed.
+
+Additional libraries:
+    pydicom
+    scandir (python2 only)
+    futures (python2 only)
+
+Usage:
+    python crawler.py /path/to/archive --cache series_index.json
+    python crawler.py /path/to/archive --stacks
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pydicom.errors import InvalidDicomError
+
+import dicom_io
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+MIN_FILES = 100
+NUM_WORKERS = 8
+CACHE_VERSION = 1
+
+
+def _scan_dir(path, mtime, min_files, read_uid):
+    """
+    List one folder. If it holds more than min_files files, it is a candidate series and the
+    series uid is read from the header of one file.
+    """
+    subdirs, files = [], []
+    for entry in scandir(path):
+        # hidden files, e.g. the index of dicom_io, are not part of the series
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        elif entry.is_file():
+            files.append(entry.name)
+
+    info = dict(mtime=mtime, subdirs=sorted(subdirs), num_files=len(files), series_uid='', uid_read=read_uid)
+    if len(files) > min_files and read_uid:
+        names = sorted(name for name in files if '.dcm' in name) or sorted(files)
+        try:
+            info['series_uid'] = dicom_io.read_header(os.path.join(path, names[0]))['series_uid']
+        except (IOError, OSError, InvalidDicomError):
+            pass
+    return info
+
+
+def _dir_info(path, min_files, read_uid, cached):
+    """
+    Info of one folder, taken from cached if its mtime is unchanged and it has a series uid when
+    read_uid asks for one. None if the folder is gone.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    info = cached.get(path)
+    if info is None or info['mtime'] != mtime or (read_uid and not info.get('uid_read')):
+        info = _scan_dir(path, mtime, min_files, read_uid)
+    return info
+
+
+def _walk(top, min_files, read_uid, cached):
+    """
+    Iterative walk of a subtree
+    :return: dict of path -> folder info
+    """
+    dirs = dict()
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        info = _dir_info(path, min_files, read_uid, cached)
+        if info is None:
+            continue
+        dirs[path] = info
+        stack.extend(os.path.join(path, name) for name in reversed(info['subdirs']))
+    return dirs
+
+
+def _load_cache(cache_path, root, min_files):
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+    if cache.get('version') != CACHE_VERSION or cache.get('root') != root or cache.get('min_files') != min_files:
+        return dict()
+    return cache['dirs']
+
+
+def _save_cache(cache_path, root, min_files, dirs):
+    if os.path.dirname(cache_path) and not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(version=CACHE_VERSION, root=root, min_files=min_files, dirs=dirs), f)
+    os.rename(tmp_path, cache_path)
+
+
+def split_series(series):
+    """
+    Stacks of a candidate series, as split by dicom_io.split_stacks, e.g. the several series or orientations
+    mixed in one folder. The headers of every file are read once, then cached by dicom_io.scan_series.
+    :param series: dict(path, ...) of crawl
+    :return: list of dict(path, num_files, series_uid, stack, num_stacks), by decreasing number of slices,
+             stack being the index of the stack for main.loadDicom
+    """
+    stacks = dicom_io.split_stacks(dicom_io.scan_series(series['path']))
+    return [dict(path=series['path'], num_files=len(stack['indices']), series_uid=stack['series_uid'], stack=k,
+                 num_stacks=len(stacks)) for k, stack in enumerate(stacks)]
+
+
+def _split_or_keep(series):
+    try:
+        return split_series(series)
+    except Exception as e:
+        return [dict(series, error='%s: %s' % (type(e).__name__, e))]
+
+
+def crawl(root, min_files=MIN_FILES, num_workers=NUM_WORKERS, cache_path=None, read_uid=True, stacks=False):
+    """
+    Index every candidate series under root
+    :param root: root folder of the dataset
+    :param min_files: a folder holding more than min_files files is a candidate series
+    :param num_workers: number of threads walking the subtrees of root in parallel
+    :param cache_path: json file caching the crawl, refreshed incrementally by folder mtime. None for no cache
+    :param read_uid: whether to read the series uid from one header of each candidate
+    :param stacks: split each candidate into its stacks by split_series, reading every header. A candidate
+                   whose headers cannot be split is kept whole, with the error
+    :return: list of dict(path, num_files, series_uid), sorted by path, with the stack and num_stacks of
+             split_series if stacks
+    """
+    root = os.path.abspath(root)
+    cached = _load_cache(cache_path, root, min_files) if cache_path is not None else dict()
+
+    # the subtrees of root are walked in parallel
+    info = _dir_info(root, min_files, read_uid, cached)
+    if info is None:
+        raise IOError('%s does not exist' % root)
+    dirs = {root: info}
+    subtrees = [os.path.join(root, name) for name in info['subdirs']]
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        for subtree_dirs in executor.map(lambda top: _walk(top, min_files, read_uid, cached), subtrees):
+            dirs.update(subtree_dirs)
+
+    if cache_path is not None:
+        _save_cache(cache_path, root, min_files, dirs)
+
+    candidates = [dict(path=path, num_files=dirs[path]['num_files'], series_uid=dirs[path]['series_uid'])
+                  for path in sorted(dirs) if dirs[path]['num_files'] > min_files]
+    if stacks:
+        candidates = [stack for series in candidates for stack in _split_or_keep(series)]
+    return candidates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the DICOM series under a root folder')
+    parser.add_argument('root', type=str)
+    parser.add_argument('--cache', type=str, default=None, help='json file caching the crawl')
+    parser.add_argument('--min_files', type=int, default=MIN_FILES)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--stacks', action='store_true', help='list each stack of the folders mixing several')
+    args = parser.parse_args()
+
+    for series in crawl(args.root, args.min_files, args.workers, args.cache, stacks=args.stacks):
+        line = '%s\t%d\t%s' % (series['path'], series['num_files'], series['series_uid'])
+        if 'stack' in series:
+            line += '\t%d' % series['stack']
+        print(line + '\t' + series['error'] if 'error' in series else line)
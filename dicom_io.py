@@ -0,0 +1,365 @@
+""" Implementation of helpers to read a DICOM series
+The header pass runs on a thread pool and its result is cached per series in a compact
+index file, so that re-opening an unchanged series skips header parsing completely. The indices
+are saved in a user cache folder, the archive itself is left untouched unless asked for. The cache
+folder is capped to INDEX_CACHE_MB, the least recently used indices being removed beyond it, and
+prune_index_cache(max_mb=0) empties it.
+The pixel data can be decoded by worker threads straight into one preallocated volume.
+
+Additional libraries:
+    numpy
+    pydicom
+    futures (python2 only)
+
+Summary of available functions:
+    list_series_files: list the dicom files of a folder with their stat
+    read_header: read the tags needed by the loader from one dicom file
+    scan_series: header pass over a series, served from the index when possible
+    prune_index_cache: remove the least recently used indices of the cache folder beyond a size
+    slice_order: sort the slices of a series along the slice normal
+    split_stacks: split a folder into stacks of slices and check their spacing
+    subset_header: header of a subset of the files
+    read_series: multi-threaded decode of a series into a (y, x, z) volume
+"""
+
+import hashlib
+import os
+import numpy as np
+import pydicom as dicom
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+INDEX_NAME = '.series_index.npz'  # name of the index when saved inside the series folder
+# folder of the indices, one file per series
+INDEX_CACHE_DIR = os.environ.get('DICOM_IO_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'dicom_io'))
+# size of the cache folder, in MB, beyond which the least recently used indices are removed
+INDEX_CACHE_MB = float(os.environ.get('DICOM_IO_CACHE_MB', 512))
+INDEX_VERSION = 1
+NUM_WORKERS = 16
+DUPLICATE_TOL = 1e-3  # slices of a stack closer than this, in mm, are duplicates
+SPACING_TOL = 1e-3  # steps differing from the spacing of a stack by more than this fraction are irregular
+GAP_RATIO = 1.5  # steps larger than this many times the spacing of a stack are gaps
+
+# tags read from every file, the pixel data is never touched
+HEADER_TAGS = ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'SliceThickness',
+               'InstanceNumber', 'RescaleSlope', 'RescaleIntercept', 'Rows', 'Columns',
+               'SeriesInstanceUID', 'PatientAge', 'PatientSex']
+
+
+def list_series_files(dicom_dir):
+    """
+    List the dicom files of a folder, sorted by name
+    :param dicom_dir: path of the folder
+    :return: names, mtimes and sizes of the '.dcm' files
+    """
+    names, mtimes, sizes = [], [], []
+    for entry in scandir(dicom_dir):
+        if '.dcm' not in entry.name or not entry.is_file():
+            continue
+        stat = entry.stat()
+        names.append(entry.name)
+        mtimes.append(stat.st_mtime)
+        sizes.append(stat.st_size)
+    order = np.argsort(names)
+    return [names[i] for i in order], np.array(mtimes, dtype=np.float64)[order], \
+        np.array(sizes, dtype=np.int64)[order]
+
+
+def read_header(file_name):
+    """
+    Read the tags needed by the loader from one dicom file, without the pixel data
+    :param file_name: path of the dicom file
+    :return: dict of header values, missing tags are NaN or ''
+    """
+    info = dicom.dcmread(file_name, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+
+    def get(tag, default, length=None):
+        value = getattr(info, tag, None)
+        if value is None or value == '':
+            return default
+        if length is not None:
+            return [float(v) for v in value][:length]
+        return value
+
+    return dict(position=get('ImagePositionPatient', [np.nan] * 3, 3),
+                orientation=get('ImageOrientationPatient', [np.nan] * 6, 6),
+                pixel_spacing=get('PixelSpacing', [np.nan] * 2, 2),
+                thickness=float(get('SliceThickness', np.nan)),
+                instance=int(get('InstanceNumber', -1)),
+                slope=float(get('RescaleSlope', 1.)),
+                intercept=float(get('RescaleIntercept', 0.)),
+                rows=int(get('Rows', 0)),
+                columns=int(get('Columns', 0)),
+                series_uid=str(get('SeriesInstanceUID', '')),
+                age=str(get('PatientAge', '')),
+                sex=str(get('PatientSex', '')))
+
+
+def index_path(dicom_dir, cache_dir=None, in_folder=False):
+    """
+    Path of the metadata index of a series
+    :param dicom_dir: path of the series folder
+    :param cache_dir: folder of the indices, INDEX_CACHE_DIR if None
+    :param in_folder: save the index inside the series folder instead, which modifies the archive
+    :return: path of the index file
+    """
+    if in_folder:
+        return os.path.join(dicom_dir, INDEX_NAME)
+    if cache_dir is None:
+        cache_dir = INDEX_CACHE_DIR
+    dicom_dir = os.path.abspath(dicom_dir)
+    # the name of the folder for readability, the hash of its path for uniqueness
+    key = '%s_%s' % (os.path.basename(dicom_dir), hashlib.md5(dicom_dir.encode('utf-8')).hexdigest())
+    return os.path.join(cache_dir, key + '.npz')
+
+
+def _load_index(path, names, mtimes, sizes):
+    """
+    Load the index if it matches the current files of the series, otherwise return None
+    """
+    try:
+        with np.load(path) as index:
+            header = dict((key, index[key]) for key in index.files)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    if int(header.pop('version')) != INDEX_VERSION \
+            or header['names'].tolist() != names \
+            or not np.array_equal(header['mtimes'], mtimes) \
+            or not np.array_equal(header['sizes'], sizes):
+        return None
+    return header
+
+
+def _save_index(path, header):
+    """
+    Save the index atomically. The folder might be read-only, in which case nothing is saved.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, **header)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def prune_index_cache(cache_dir=None, max_mb=INDEX_CACHE_MB):
+    """
+    Remove the least recently used indices of the cache folder until it holds at most max_mb.
+    An index is used when saved or loaded by scan_series.
+    :param cache_dir: folder of the indices, INDEX_CACHE_DIR if None
+    :param max_mb: size to keep, 0 to empty the cache
+    :return: number of indices removed
+    """
+    if cache_dir is None:
+        cache_dir = INDEX_CACHE_DIR
+    try:
+        entries = [entry for entry in scandir(cache_dir) if entry.name.endswith('.npz') and entry.is_file()]
+        stats = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries]
+    except OSError:
+        return 0
+    removed, total = 0, 0
+    for _, size, path in sorted(stats, reverse=True):
+        total += size
+        if total > max_mb * 2 ** 20:
+            try:
+                # another process might have removed it already
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def scan_series(dicom_dir, num_workers=NUM_WORKERS, cache_dir=None, use_cache=True, in_folder=False):
+    """
+    Header pass over a series. The headers are read on a thread pool and cached in an index,
+    which is reused as long as names, mtimes and sizes of the files are unchanged.
+    :param dicom_dir: path of the folder saving the dicom files
+    :param num_workers: number of threads to read the headers
+    :param cache_dir: where to save the index, see index_path. The folder is pruned by prune_index_cache
+    :param use_cache: False to force reading the headers
+    :param in_folder: save the index inside the series folder, see index_path
+    :return: dict of per-file arrays (names, mtimes, sizes, position, orientation, pixel_spacing,
+             thickness, instance, slope, intercept, rows, columns, series_uid) and per-series
+             strings (age, sex)
+    """
+    names, mtimes, sizes = list_series_files(dicom_dir)
+    path = index_path(dicom_dir, cache_dir, in_folder)
+    if use_cache:
+        header = _load_index(path, names, mtimes, sizes)
+        if header is not None:
+            if not in_folder:
+                try:
+                    # the time of use of the index for prune_index_cache
+                    os.utime(path, None)
+                except OSError:
+                    pass
+            return header
+
+    file_names = [os.path.join(dicom_dir, name) for name in names]
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        infos = list(executor.map(read_header, file_names))
+
+    header = dict(names=np.array(names), mtimes=mtimes, sizes=sizes)
+    for key in ['position', 'orientation', 'pixel_spacing', 'thickness', 'slope', 'intercept']:
+        header[key] = np.array([info[key] for info in infos], dtype=np.float64)
+    for key in ['instance', 'rows', 'columns']:
+        header[key] = np.array([info[key] for info in infos], dtype=np.int32)
+    header['series_uid'] = np.array([info['series_uid'] for info in infos])
+    # age and sex are the same along the series, keep the first non-empty value
+    for key in ['age', 'sex']:
+        header[key] = np.array(next((info[key] for info in infos if info[key]), ''))
+
+    if use_cache:
+        _save_index(path, header)
+        if not in_folder:
+            prune_index_cache(cache_dir)
+    return header
+
+
+def slice_normal(orientation):
+    """
+    Normal of the slices, i.e. cross product of the row and column direction cosines
+    :param orientation: (6,) ImageOrientationPatient
+    :return: (3,) normal
+    """
+    orientation = np.asarray(orientation, dtype=np.float64)
+    return np.cross(orientation[0:3], orientation[3:6])
+
+
+def slice_order(header):
+    """
+    Sort the slices along the slice normal, in the same order as GDCM does
+    :param header: header returned by scan_series
+    :return: indices sorting the files, sorted positions along the normal
+    """
+    if len(header['names']) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    normal = slice_normal(header['orientation'][0])
+    if not np.all(np.isfinite(normal)):
+        normal = np.array([0., 0., 1.])
+    positions = np.dot(header['position'], normal)
+    order = np.argsort(positions, kind='mergesort')
+    return order, positions[order]
+
+
+def split_stacks(header, duplicate_tol=DUPLICATE_TOL, spacing_tol=SPACING_TOL):
+    """
+    Position analysis of a folder in one pass over arrays: the slices are grouped into stacks by series
+    uid and orientation, sorted along the slice normal, and checked for duplicates, gaps and irregular steps.
+    Duplicates are dropped, the first file of the sort order being kept.
+    :param header: header returned by scan_series
+    :return: list of dict(indices, positions, spacing, uniform, duplicates, gaps, series_uid), by decreasing
+             number of slices. indices sort the files of the stack, spacing is the median step, uniform tells
+             whether every step is the spacing
+    """
+    num_files = len(header['names'])
+    if num_files == 0:
+        return []
+    orientation = np.asarray(header['orientation'], dtype=np.float64).reshape(num_files, 6)
+    _, uid_id = np.unique(header['series_uid'], return_inverse=True)
+    _, orientation_id = np.unique(np.round(orientation, 4), axis=0, return_inverse=True)
+    _, stack_id = np.unique(uid_id.ravel() * num_files + orientation_id.ravel(), return_inverse=True)
+
+    normals = np.cross(orientation[:, 0:3], orientation[:, 3:6])
+    normals[~np.all(np.isfinite(normals), axis=1)] = [0., 0., 1.]
+    positions = np.einsum('ij,ij->i', header['position'], normals)
+
+    # by stack, then by position, stable as slice_order
+    order = np.lexsort((positions, stack_id))
+    steps = np.diff(positions[order])
+    duplicate = (stack_id[order][1:] == stack_id[order][:-1]) & (steps <= duplicate_tol)
+    num_duplicates = np.bincount(stack_id[order][1:][duplicate], minlength=stack_id.max() + 1)
+    order = order[np.concatenate([[True], ~duplicate])]
+
+    stack_of, sorted_positions = stack_id[order], positions[order]
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(stack_of)) + 1, [len(order)]])
+    stacks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        first = order[start]
+        steps = np.diff(sorted_positions[start:stop])
+        if len(steps):
+            spacing = float(np.median(steps))
+        else:
+            spacing = float(header['thickness'][first]) if np.isfinite(header['thickness'][first]) else 1.
+        stacks.append(dict(indices=order[start:stop], positions=sorted_positions[start:stop], spacing=spacing,
+                           uniform=bool(np.all(np.abs(steps - spacing) <= spacing_tol * spacing)),
+                           duplicates=int(num_duplicates[stack_of[start]]),
+                           gaps=int(np.sum(steps > GAP_RATIO * spacing)),
+                           series_uid=str(header['series_uid'][first])))
+    stacks.sort(key=lambda stack: -len(stack['indices']))
+    return stacks
+
+
+def subset_header(header, indices):
+    """
+    Header of the files indices of a header of scan_series, e.g. a stack of split_stacks
+    """
+    num_files = len(header['names'])
+    return dict((key, value[indices] if np.ndim(value) and len(value) == num_files else value)
+                for key, value in header.items())
+
+
+def _decode_slice(file_name, out, slope, intercept):
+    """
+    Decode the pixel data of one file into out, applying the rescale slope and intercept
+    """
+    pixel = dicom.dcmread(file_name).pixel_array
+    if slope == 1 and intercept == int(intercept):
+        # widened first, so that unsigned pixels with a negative intercept neither overflow nor wrap
+        values = np.add(pixel, int(intercept), dtype=np.int32 if pixel.dtype.itemsize < 4 else np.int64)
+    else:
+        values = pixel * slope + intercept
+        if np.issubdtype(out.dtype, np.integer):
+            np.rint(values, out=values)
+    if np.issubdtype(out.dtype, np.integer):
+        limits = np.iinfo(out.dtype)
+        np.clip(values, limits.min, limits.max, out=values)
+    np.copyto(out, values, casting='unsafe')
+
+
+def read_series(dicom_dir, header, num_workers=NUM_WORKERS, dtype=np.int16):
+    """
+    Decode a series with worker threads into one preallocated (y, x, z) volume.
+    Slices are written in place, so that peak memory is about one volume.
+    :param dicom_dir: path of the folder saving the dicom files
+    :param header: header returned by scan_series
+    :param num_workers: number of decoding threads
+    :param dtype: dtype of the volume
+    :return: dict(array, origin, spacing, direction) with yxz conventions, as main.loadDicom
+    """
+    order, positions = slice_order(header)
+    first = order[0]
+
+    array = np.empty((header['rows'][first], header['columns'][first], len(order)), dtype=dtype)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        jobs = [executor.submit(_decode_slice, os.path.join(dicom_dir, header['names'][i]), array[:, :, z],
+                                header['slope'][i], header['intercept'][i])
+                for z, i in enumerate(order)]
+        for job in jobs:
+            job.result()
+
+    position = header['position'][first]
+    origin = (float(position[1]), float(position[0]), float(position[2]))  # yxz
+    pixel_spacing = header['pixel_spacing'][first]  # row spacing, column spacing
+    if len(positions) > 1:
+        spacing_z = abs(positions[-1] - positions[0]) / (len(positions) - 1)
+    else:
+        spacing_z = header['thickness'][first] if np.isfinite(header['thickness'][first]) else 1.
+    spacing = (float(pixel_spacing[0]), float(pixel_spacing[1]), float(spacing_z))  # yxz
+
+    orientation = header['orientation'][first]
+    listDirection = np.stack([orientation[0:3], orientation[3:6], slice_normal(orientation)], axis=1).ravel()
+    assert all(listDirection[i] == 0.0 for i in range(len(listDirection)) if i not in [0, 4, 8])
+    direction = np.array([listDirection[4], listDirection[0], listDirection[8]])
+
+    return dict(array=array, origin=origin, spacing=spacing, direction=direction)
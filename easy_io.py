@@ -1,4 +1,8 @@
+import io
 import os
+import struct
+
+import numpy as np
 
 try:
     import cPickle as pickle
@@ -10,6 +14,15 @@ try:
 except NameError:
     input = input
 
+# binary container of write_bin_file: magic, header length, pickled header, then the raw buffers of the arrays
+BIN_MAGIC = b'EZIOBIN1'
+BIN_ALIGN = 64  # alignment of the buffers in the file
+INLINE_BYTES = 4096  # arrays smaller than this are pickled in the header
+
+# overwrite policies of the writers when the file exists
+# 'overwrite': replace it, 'skip': keep it and return False, 'error': raise IOError, 'ask': prompt
+OVERWRITE_POLICIES = ('overwrite', 'skip', 'error', 'ask')
+
 
 def confirm(prompt, yes='y', no='n'):
     t = None
@@ -30,17 +43,140 @@ def confirm_file_overwrite(file_path):
     return True
 
 
+def check_overwrite(file_path, overwrite='ask'):
+    """
+    Apply an overwrite policy to file_path
+    :param overwrite: one of OVERWRITE_POLICIES
+    :return: whether to write the file
+    """
+    if overwrite not in OVERWRITE_POLICIES:
+        raise ValueError('overwrite must be one of %s, got %s' % (OVERWRITE_POLICIES, overwrite))
+    if not os.path.isfile(file_path) or overwrite == 'overwrite':
+        return True
+    if overwrite == 'skip':
+        return False
+    if overwrite == 'error':
+        raise IOError('"%s" already exists' % file_path)
+    return confirm_file_overwrite(file_path)
+
+
+def _write_atomic(file_path, write_func):
+    """
+    Write into a temporary file renamed once complete, so that readers never see a partial file
+    """
+    if os.path.dirname(file_path) and not os.path.isdir(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            write_func(f)
+        os.rename(tmp_path, file_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
 def read_pkl_file(pkl_file_path):
     with open(pkl_file_path, 'rb') as f:
+        if f.read(len(BIN_MAGIC)) == BIN_MAGIC:
+            return read_bin_file(pkl_file_path)
+        f.seek(0)
         return pickle.load(f)
 
 
-def write_pkl_file(pkl_file_path, variable):
-    if not os.path.isdir(os.path.dirname(pkl_file_path)):
-        os.makedirs(os.path.dirname(pkl_file_path))
-    if confirm_file_overwrite(pkl_file_path):
-        with open(pkl_file_path, 'wb') as g:
-            pickle.dump(variable, g, 0)
+def write_pkl_file(pkl_file_path, variable, overwrite='ask'):
+    """
+    Pickle variable with the highest protocol, atomically
+    :param overwrite: policy if the file exists, see OVERWRITE_POLICIES
+    :return: whether the file was written
+    """
+    if not check_overwrite(pkl_file_path, overwrite):
+        return False
+    _write_atomic(pkl_file_path, lambda f: pickle.dump(variable, f, pickle.HIGHEST_PROTOCOL))
+    return True
+
+
+def write_bin_file(file_path, variable, overwrite='overwrite'):
+    """
+    Save variable, e.g. a dict of arrays, into a binary container: the numpy arrays are written
+    out of band as raw aligned buffers, the rest is pickled with the highest protocol.
+    read_bin_file can then memory-map the arrays without any copy. The file is written atomically.
+    :param overwrite: policy if the file exists, see OVERWRITE_POLICIES
+    :return: whether the file was written
+    """
+    if not check_overwrite(file_path, overwrite):
+        return False
+
+    arrays = []
+
+    def persistent_id(obj):
+        if type(obj) is np.ndarray and obj.dtype.kind not in 'OV' and obj.nbytes >= INLINE_BYTES:
+            arrays.append(obj)
+            return len(arrays) - 1
+        return None
+
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(variable)
+    body = buf.getvalue()
+
+    # layout of the buffers: dtype, shape, fortran order, offset from the end of the header
+    table = []
+    offset = 0
+    for array in arrays:
+        fortran = array.flags.f_contiguous and not array.flags.c_contiguous
+        table.append((array.dtype.str, array.shape, fortran, offset))
+        offset = _align(offset + array.nbytes)
+    header = pickle.dumps((body, table), pickle.HIGHEST_PROTOCOL)
+    data_start = _align(len(BIN_MAGIC) + 8 + len(header))
+
+    def write(f):
+        f.write(BIN_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for array, (_, _, fortran, array_offset) in zip(arrays, table):
+            f.write(b'\0' * (data_start + array_offset - f.tell()))
+            # a contiguous array is written from its own memory, without a copy
+            f.write(np.ascontiguousarray(array.T if fortran else array).data)
+
+    _write_atomic(file_path, write)
+    return True
+
+
+def read_bin_file(file_path, mmap_mode='r'):
+    """
+    Load a file of write_bin_file
+    :param mmap_mode: mode of the memory maps of the arrays, 'r' for read-only, 'c' for copy-on-write,
+                      None to read the arrays into memory
+    :return: variable
+    """
+    with open(file_path, 'rb') as f:
+        if f.read(len(BIN_MAGIC)) != BIN_MAGIC:
+            raise IOError('"%s" is not a file of write_bin_file' % file_path)
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        body, table = pickle.loads(f.read(header_size))
+        data_start = _align(len(BIN_MAGIC) + 8 + header_size)
+
+        arrays = []
+        for dtype, shape, fortran, offset in table:
+            dtype = np.dtype(dtype)
+            if mmap_mode is not None:
+                array = np.memmap(file_path, dtype=dtype, mode=mmap_mode, offset=data_start + offset,
+                                  shape=shape[::-1] if fortran else shape)
+            else:
+                array = np.empty(shape[::-1] if fortran else shape, dtype=dtype)
+                f.seek(data_start + offset)
+                f.readinto(array.reshape(-1).view(np.uint8))
+            arrays.append(array.T if fortran else array)
+
+    unpickler = pickle.Unpickler(io.BytesIO(body))
+    unpickler.persistent_load = lambda array_id: arrays[int(array_id)]
+    return unpickler.load()
+
+
+def _align(offset):
+    return (offset + BIN_ALIGN - 1) // BIN_ALIGN * BIN_ALIGN
 
 
 def make_dir(*args):
@@ -48,4 +184,4 @@ def make_dir(*args):
         if not os.path.isdir(dir_path):
             os.makedirs(dir_path)
         else:
-            print '%s exists.' % dir_path
+            print('%s exists.' % dir_path)
@@ -0,0 +1,152 @@
+""" Evaluation of detection results against the nodule labels, FROC and CPM as LUNA16
+A prediction [confidence, dim0, dim1, dim2, diameter] hits a nodule if its center is inside the sphere
+of the nodule, or if the iou of their bounding boxes exceeds a threshold. Per series, the hits are
+one vectorized matrix, and the series are matched in parallel. Several predictions hitting the same
+nodule count once, with their highest confidence, and are not false positives.
+
+Usage:
+    python evaluation.py /path/to/test_result.bin /path/to/npy_nodule_mask_zoomed/test --nms 0.1
+"""
+
+import argparse
+import os
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+import bbox as B
+
+FP_RATES = (0.125, 0.25, 0.5, 1, 2, 4, 8)  # false positives per scan of the CPM
+
+
+def hit_matrix(pred, coords, diameters, mode='sphere', iou_threshold=0.1):
+    """
+    Hits between predictions and nodules
+    :param pred: (K, 5) predictions [confidence, dim0, dim1, dim2, diameter]
+    :param coords: (G, 3) centers of the nodules
+    :param diameters: (G,) diameters of the nodules
+    :param mode: 'sphere' for the center of the prediction inside the nodule, 'iou' for the iou of the boxes
+    :param iou_threshold: minimal iou of a hit in mode 'iou'
+    :return: (K, G) bool
+    """
+    if mode == 'sphere':
+        dist2 = np.sum((pred[:, np.newaxis, 1:4] - coords[np.newaxis, :, :]) ** 2, axis=-1)
+        return dist2 <= (diameters[np.newaxis, :] / 2.) ** 2
+    elif mode == 'iou':
+        return B.iou(B.center2bbox(pred[:, 1:4], pred[:, 4]), B.center2bbox(coords, diameters)) > iou_threshold
+    raise ValueError('mode must be sphere or iou, got %s' % mode)
+
+
+def match_series(pred, coords, diameters, mode='sphere', iou_threshold=0.1, nms_threshold=None):
+    """
+    Match the predictions of one series
+    :param nms_threshold: optional, the predictions go through bbox.nms first
+    :return: confidences of the false positives, highest confidence hitting each nodule (-inf if missed)
+    """
+    pred = np.reshape(pred, (-1, 5)).astype(np.float64)
+    coords = np.reshape(coords, (-1, 3)).astype(np.float64)
+    diameters = np.reshape(diameters, (-1,)).astype(np.float64)
+    if nms_threshold is not None and len(pred):
+        pred = pred[B.nms(B.center2bbox(pred[:, 1:4], pred[:, 4]), pred[:, 0], nms_threshold)]
+
+    hits = hit_matrix(pred, coords, diameters, mode, iou_threshold)
+    fp_conf = pred[~np.any(hits, axis=1), 0]
+    gt_best = np.max(np.where(hits, pred[:, 0:1], -np.inf), axis=0) if len(pred) else np.full(len(coords), -np.inf)
+    return fp_conf, gt_best
+
+
+def _match_job(job):
+    return match_series(*job)
+
+
+def froc(fp_conf, gt_best, num_scans):
+    """
+    FROC curve, one point per distinct confidence threshold
+    :param fp_conf: confidences of the false positives of all series
+    :param gt_best: highest confidence hitting each nodule of all series, -inf if missed
+    :param num_scans: number of series
+    :return: false positives per scan, sensitivity and thresholds, by decreasing threshold
+    """
+    fp_conf = np.sort(fp_conf)
+    gt_best = np.sort(gt_best)
+    thresholds = np.unique(np.concatenate([fp_conf, gt_best[np.isfinite(gt_best)]]))[::-1]
+    # number of values >= threshold
+    num_fp = len(fp_conf) - np.searchsorted(fp_conf, thresholds, side='left')
+    num_tp = len(gt_best) - np.searchsorted(gt_best, thresholds, side='left')
+    return num_fp / float(max(num_scans, 1)), num_tp / float(max(len(gt_best), 1)), thresholds
+
+
+def cpm(fps, sensitivity, fp_rates=FP_RATES):
+    """
+    Competition performance metric, the mean sensitivity at fp_rates false positives per scan
+    :return: cpm, sensitivity at each rate
+    """
+    if len(fps) == 0:
+        return 0., np.zeros(len(fp_rates))
+    # the sensitivity at a rate is the one of the lowest threshold giving at most that many false positives
+    index = np.searchsorted(fps, fp_rates, side='right') - 1
+    sensitivities = np.where(index >= 0, sensitivity[np.maximum(index, 0)], 0.)
+    return float(np.mean(sensitivities)), sensitivities
+
+
+def load_labels(label_dir, uids):
+    """
+    :return: dict of uid -> (coords, diameters), no nodule for a missing label file
+    """
+    labels = dict()
+    for uid in uids:
+        label_file = os.path.join(label_dir, uid + '.npz')
+        if os.path.isfile(label_file):
+            with np.load(label_file) as label:
+                labels[uid] = (label['nodule_voxel_coord'], label['nodule_voxel_diameter'])
+        else:
+            labels[uid] = (np.zeros((0, 3)), np.zeros(0))
+    return labels
+
+
+def evaluate(results, labels, mode='sphere', iou_threshold=0.1, nms_threshold=None, num_workers=None):
+    """
+    FROC and CPM over a test set
+    :param results: dict of uid -> (K, 5) predictions, or a results_store.ResultsStore
+    :param labels: dict of uid -> (coords, diameters), see load_labels. Every uid of results is evaluated
+    :param num_workers: number of processes matching the series, cpu count if None, 1 for none
+    :return: dict(fps, sensitivity, thresholds, cpm, sensitivities), sensitivities at FP_RATES
+    """
+    uids = list(results.keys())
+    jobs = [(results[uid], labels[uid][0], labels[uid][1], mode, iou_threshold, nms_threshold) for uid in uids]
+    num_workers = num_workers or cpu_count()
+    if num_workers > 1 and len(jobs) > 1:
+        pool = Pool(num_workers)
+        try:
+            matches = pool.map(_match_job, jobs, chunksize=max(1, len(jobs) // (4 * num_workers)))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        matches = [_match_job(job) for job in jobs]
+
+    fp_conf = np.concatenate([fp for fp, _ in matches] + [np.zeros(0)])
+    gt_best = np.concatenate([gt for _, gt in matches] + [np.zeros(0)])
+    fps, sensitivity, thresholds = froc(fp_conf, gt_best, len(uids))
+    score, sensitivities = cpm(fps, sensitivity)
+    return dict(fps=fps, sensitivity=sensitivity, thresholds=thresholds, cpm=score, sensitivities=sensitivities)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FROC and CPM of detection results')
+    parser.add_argument('store', type=str, help='results store, see results_store.py')
+    parser.add_argument('label_dir', type=str)
+    parser.add_argument('--mode', type=str, default='sphere', choices=['sphere', 'iou'])
+    parser.add_argument('--iou', type=float, default=0.1, help='minimal iou of a hit in mode iou')
+    parser.add_argument('--nms', type=float, default=None, help='iou threshold of a nms before the evaluation')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    import results_store
+
+    results = results_store.ResultsStore(args.store)
+    res = evaluate(results, load_labels(args.label_dir, results.keys()), args.mode, args.iou, args.nms,
+                   args.workers)
+    for rate, sensitivity in zip(FP_RATES, res['sensitivities']):
+        print('%6.3f FPs/scan: sensitivity %.3f' % (rate, sensitivity))
+    print('CPM: %.3f' % res['cpm'])
@@ -0,0 +1,176 @@
+""" Headless export of slice montages and bbox overlays for a whole dataset
+Same layouts as viewer.vis_slices and viewer.vis_slice, but rendered with Agg figures created once
+per worker process and reused for every image, with the scans fanned out across a process pool.
+
+For each nodule of each scan:
+    <out_dir>/<scan>_<id>.png: montage of the slices of a sub-volume centered on the nodule
+    <out_dir>/<scan>_<id>_overlay.png: optional, axial slice through the nodule center with the bboxes
+
+Usage:
+    python export_montage.py /path/to/npy_data_zoomed/train /path/to/npy_nodule_mask_zoomed/train out_dir
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+
+import argparse
+import os
+import time
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import bbox as B
+import viewer
+
+WINDOW = (-1024, 300)  # display range, as the clipping of check_data
+
+
+class MontageFigure(object):
+    """
+    Reusable figure of nrows x ncols slices, the layout of viewer.vis_slices
+    """
+    def __init__(self, num_slices, slice_shape, ncols=8, window=WINDOW, color=False, figsize=(12, 6)):
+        nrows = int(np.ceil(num_slices / float(ncols)))
+        self.fig = Figure(figsize=figsize)
+        FigureCanvasAgg(self.fig)
+        self.images = []
+        for ind in range(nrows * ncols):
+            ax = self.fig.add_subplot(nrows, ncols, ind + 1)
+            ax.axis('off')
+            if ind < num_slices:
+                self.images.append(ax.imshow(np.zeros(slice_shape), cmap=None if color else 'bone',
+                                             vmin=window[0], vmax=window[1], interpolation='nearest'))
+        self.title = self.fig.suptitle('')
+
+    def render(self, slices, title, path):
+        """
+        :param slices: iterable of slices, as many as the figure was built for
+        """
+        for image, image_slice in zip(self.images, slices):
+            image.set_data(image_slice)
+        self.title.set_text(title)
+        self.fig.savefig(path)
+
+
+class OverlayFigure(object):
+    """
+    Reusable figure of a slice with bounding boxes, the layout of viewer.vis_slice
+    """
+    def __init__(self, window=WINDOW, color=False, figsize=viewer.FIG_SIZE):
+        self.fig = Figure(figsize=figsize)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.axis('off')
+        self.image = self.ax.imshow(np.zeros((1, 1)), cmap=None if color else 'bone',
+                                    vmin=window[0], vmax=window[1], interpolation='nearest')
+        self.pool = viewer.BoxPool(self.ax)
+
+    def render(self, image_slice, boxes, ids, title, path, color_list=None, attr_list=None):
+        """
+        :param boxes: boxes projected on the slice, see viewer.project_bbox
+        :param ids: ids of the boxes to draw
+        """
+        rows, cols = image_slice.shape
+        self.image.set_data(image_slice)
+        self.image.set_extent((-0.5, cols - 0.5, rows - 0.5, -0.5))
+        self.ax.set_xlim(-0.5, cols - 0.5)
+        self.ax.set_ylim(rows - 0.5, -0.5)
+        self.pool.update(boxes, ids, color_list, attr_list)
+        self.ax.set_title(title)
+        self.fig.savefig(path)
+
+
+# figures of the worker process, reused across scans
+_figures = dict()
+
+
+def _figure(key, factory):
+    if key not in _figures:
+        _figures[key] = factory()
+    return _figures[key]
+
+
+def export_scan(scan_name, data_file, label_file, out_dir, size=40, ncols=8, overlay=False):
+    """
+    Export the montages, and optionally the overlays, of every nodule of a scan
+    :param scan_name: prefix of the images
+    :param data_file: .npy volume, memory-mapped
+    :param label_file: .npz with nodule_voxel_coord and nodule_voxel_diameter
+    :param out_dir: folder to save the images
+    :param size: size of the cube cropped around each nodule
+    :param ncols: number of columns of the montages
+    :param overlay: also export the slice through each nodule center with all the bboxes
+    :return: number of images written
+    """
+    vol = np.load(data_file, mmap_mode='r')
+    with np.load(label_file) as labels:
+        coords = labels['nodule_voxel_coord']
+        diameters = labels['nodule_voxel_diameter']
+
+    num_images = 0
+    montage = _figure(('montage', size, ncols), lambda: MontageFigure(size, (size, size), ncols))
+    subvols = B.create_subvols(vol, [B.center2bbox(coord, size) for coord in coords], padding_value=WINDOW[0])
+    for nodule_id, (subvol, diameter) in enumerate(zip(subvols, diameters)):
+        montage.render(subvol, str(diameter), os.path.join(out_dir, '%s_%d.png' % (scan_name, nodule_id)))
+        num_images += 1
+
+    if overlay and len(coords):
+        figure = _figure('overlay', OverlayFigure)
+        boxes = [viewer.project_bbox(B.center2bbox(coord, diameter), viewer.AXIAL)
+                 for coord, diameter in zip(coords, diameters)]
+        index = viewer.SliceIndex(boxes, 2, vol.shape[2])
+        for nodule_id, coord in enumerate(coords):
+            z = int(np.clip(np.round(coord[2]), 0, vol.shape[2] - 1))
+            figure.render(vol[:, :, z], boxes, index.query(z), '%s z=%d' % (scan_name, z),
+                          os.path.join(out_dir, '%s_%d_overlay.png' % (scan_name, nodule_id)))
+            num_images += 1
+    return num_images
+
+
+def _export_job(job):
+    return export_scan(*job)
+
+
+def export_dataset(data_dir, label_dir, out_dir, num_workers=None, size=40, ncols=8, overlay=False):
+    """
+    Export the images of every scan of data_dir having a label file, across a process pool
+    :return: number of images written
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    jobs = []
+    for data_file in sorted(os.listdir(data_dir)):
+        scan_name = os.path.splitext(data_file)[0]
+        label_file = os.path.join(label_dir, scan_name + '.npz')
+        if data_file.endswith('.npy') and os.path.isfile(label_file):
+            jobs.append((scan_name, os.path.join(data_dir, data_file), label_file, out_dir, size, ncols, overlay))
+
+    num_images = 0
+    t = time.time()
+    pool = Pool(num_workers or cpu_count())
+    try:
+        for num_done, count in enumerate(pool.imap_unordered(_export_job, jobs)):
+            num_images += count
+            print('[%d/%d] %d images, %.1f images/s' % (num_done + 1, len(jobs), num_images,
+                                                       num_images / (time.time() - t)))
+    finally:
+        pool.terminate()
+        pool.join()
+    return num_images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export slice montages of every nodule of a dataset')
+    parser.add_argument('data_dir', type=str)
+    parser.add_argument('label_dir', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--size', type=int, default=40, help='size of the cube cropped around each nodule')
+    parser.add_argument('--ncols', type=int, default=8)
+    parser.add_argument('--overlay', action='store_true', help='also export the slices with the bboxes')
+    args = parser.parse_args()
+
+    export_dataset(args.data_dir, args.label_dir, args.out_dir, args.workers, args.size, args.ncols, args.overlay)
@@ -5,40 +5,183 @@ Notice: channel axis is set to 0 as default, and padding value is 0
 Additional libraries:
     numpy
     scipy.ndimage
+    futures (python2 only)
 """
 
 import numpy as np
 import scipy.ndimage as ndi
+from concurrent.futures import ThreadPoolExecutor
+
+import intensity
+import profiler
 
 constant_value = 0.
+AUGMENT_WORKERS = 4  # threads of augment_batch
+RESAMPLE_CHUNK_MB = 64  # working memory of each slab of interpolation
+SPLINE_PAD = 12  # margin of the spline prefilter, as ndi.map_coordinates with mode 'nearest'
+
+
+def _axis_taps(num_in, step, order):
+    """
+    Taps of the 1D resampling of an axis at the coordinates of np.mgrid[0:num_in:step]
+    :return: (num_out, order + 1) indices into the axis and weights, the indices are not clipped
+    """
+    num_out = int(np.ceil(num_in / float(step)))
+    coords = np.arange(num_out) * float(step)
+    if order == 0:
+        indices = np.floor(coords + 0.5)[:, np.newaxis]
+        weights = np.ones_like(indices)
+    elif order == 1:
+        start = np.floor(coords)
+        t = coords - start
+        indices = start[:, np.newaxis] + np.arange(2)
+        weights = np.stack([1 - t, t], axis=1)
+    elif order == 3:
+        # cubic B-spline
+        start = np.floor(coords)
+        t = coords - start
+        indices = start[:, np.newaxis] + np.arange(-1, 3)
+        weights = np.stack([(1 - t) ** 3, 3 * t ** 3 - 6 * t ** 2 + 4, -3 * t ** 3 + 3 * t ** 2 + 3 * t + 1, t ** 3],
+                           axis=1) / 6.
+    else:
+        raise ValueError('order must be 0, 1 or 3, got %s' % order)
+    return indices.astype(np.int64), weights
+
+
+def _resample_axis(x, axis, offset, num_in, indices, weights, order):
+    """
+    Resample x along axis at the taps, i.e. out[k] = sum_t weights[k, t] * x[indices[k, t]]
+    :param x: array whose axis holds the input indices offset, offset + 1, ... of an axis of length num_in
+    :param indices: (num_out, order + 1) taps, out of [0, num_in) they take the nearest edge
+    :return: float64 array
+    """
+    pad = SPLINE_PAD if order > 1 else 0
+    start = indices.min() - pad
+    # gathering clipped positions pads with the edges, as the mode 'nearest'
+    src = np.clip(np.arange(start, indices.max() + 1 + pad), 0, num_in - 1)
+    x = np.take(x, src - offset, axis=axis).astype(np.float64, copy=False)
+    if order > 1:
+        x = ndi.spline_filter1d(x, order, axis=axis, mode='nearest')
+
+    shape = [1] * x.ndim
+    shape[axis] = -1
+    out = None
+    for t in range(weights.shape[1]):
+        tap = np.take(x, indices[:, t] - start, axis=axis)
+        tap *= weights[:, t].reshape(shape)
+        if out is None:
+            out = tap
+        else:
+            out += tap
+    return out
+
+
+def _resample_slab(vol, out, taps, z_start, z_stop, order):
+    """
+    Resample the output slab out[:, :, z_start:z_stop], along z, then y and x. Taps of None keep the axis.
+    """
+    if taps[2] is None:
+        slab = np.asarray(vol[:, :, z_start:z_stop], dtype=np.float64)
+    else:
+        indices, weights = taps[2][0][z_start:z_stop], taps[2][1][z_start:z_stop]
+        pad = SPLINE_PAD if order > 1 else 0
+        # only the input slices needed by the slab are read
+        lo = int(np.clip(indices.min() - pad, 0, vol.shape[2] - 1))
+        hi = int(np.clip(indices.max() + 1 + pad, lo + 1, vol.shape[2]))
+        slab = _resample_axis(vol[:, :, lo:hi], 2, lo, vol.shape[2], indices, weights, order)
+    for axis in (0, 1):
+        if taps[axis] is not None:
+            slab = _resample_axis(slab, axis, 0, vol.shape[axis], taps[axis][0], taps[axis][1], order)
+
+    if np.issubdtype(out.dtype, np.integer):
+        # rounded half away from zero, as ndi.map_coordinates
+        slab = np.copysign(np.floor(np.abs(slab) + 0.5), slab)
+    np.copyto(out[:, :, z_start:z_stop], slab, casting='unsafe')
 
 
 # image pre-processing
-def interpolation(vol, ori_spacing, new_spacing=None):
+@profiler.timed('interpolation')
+def interpolation(vol, ori_spacing, new_spacing=None, order=1, num_workers=1, chunk_mb=RESAMPLE_CHUNK_MB):
+    """
+    Resample a volume to a new spacing, on the grid np.mgrid[0:shape:new_spacing / ori_spacing] with
+    the boundary mode 'nearest', as ndi.map_coordinates does.
+    The resampling is separable and runs by slabs along z, so that the working memory is bounded by
+    chunk_mb instead of full-size coordinate grids.
+    :param vol: (y, x, z) volume, only required to support [] operator along z, e.g. a memory map
+    :param ori_spacing: spacing of vol
+    :param new_spacing: spacing of the output. If None, z is resampled to the largest in-plane spacing
+    :param order: 0, 1 or 3, order of the spline
+    :param num_workers: number of threads processing the slabs
+    :param chunk_mb: working memory of each slab in MB
+    :return: resampled volume of the dtype of vol, new spacing
+    """
     if new_spacing is None:
         new_spacing = np.array([ori_spacing[0], ori_spacing[1], np.max(ori_spacing[0:2])])
 
-    ori_shape = vol.shape
-    vol = ndi.map_coordinates(
-        vol,
-        np.mgrid[0:ori_shape[0]:(new_spacing[0]/ori_spacing[0]),
-            0:ori_shape[1]:(new_spacing[1]/ori_spacing[1]),
-            0:ori_shape[2]:(new_spacing[2]/ori_spacing[2])],
-        order=1,
-        mode='nearest'
-    )
+    taps = []
+    for num_in, ori, new in zip(vol.shape, ori_spacing, new_spacing):
+        step = float(new) / float(ori)
+        # an axis kept as is needs no resampling
+        taps.append(None if step == 1 else _axis_taps(num_in, step, order))
+    out_shape = tuple(num_in if tap is None else len(tap[0]) for num_in, tap in zip(vol.shape, taps))
+    out = np.empty(out_shape, dtype=vol.dtype)
+
+    # about 4 float64 buffers of the size of the slab are alive at once
+    slab_size = max(1, int(chunk_mb * 1024 ** 2 // (4 * 8 * max(vol.shape[0], out_shape[0])
+                                                      * max(vol.shape[1], out_shape[1]))))
+    slabs = [(z, min(z + slab_size, out_shape[2])) for z in range(0, out_shape[2], slab_size)]
+    profiler.count('resample_slabs', len(slabs))
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for job in [executor.submit(_resample_slab, vol, out, taps, z_start, z_stop, order)
+                        for z_start, z_stop in slabs]:
+                job.result()
+    else:
+        for z_start, z_stop in slabs:
+            _resample_slab(vol, out, taps, z_start, z_stop, order)
+
+    return out, new_spacing
+
 
-    assert ori_shape[0:2] == vol.shape[0:2]
+@profiler.timed('resample_slices')
+def resample_slices(vol, positions, spacing):
+    """
+    Resample linearly along z the slices of a volume taken at irregular positions, e.g. with gaps,
+    onto a uniform grid starting at the first slice. Only two input slices are read per output slice.
+    :param vol: (y, x, z) volume, only required to support [] operator along z
+    :param positions: (z,) increasing positions of the slices
+    :param spacing: spacing of the output along z
+    :return: resampled volume of the dtype of vol, positions of its slices
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if len(positions) < 2:
+        return np.asarray(vol), positions
+    num_out = int(np.floor((positions[-1] - positions[0]) / spacing + 1e-6)) + 1
+    new_positions = positions[0] + spacing * np.arange(num_out)
+    upper = np.clip(np.searchsorted(positions, new_positions, side='right'), 1, len(positions) - 1)
+    lower = upper - 1
+    weights = np.clip((new_positions - positions[lower]) / (positions[upper] - positions[lower]), 0., 1.)
 
-    return vol, new_spacing
+    out = np.empty(vol.shape[0:2] + (num_out,), dtype=vol.dtype)
+    for z in range(num_out):
+        if weights[z] == 0:
+            out[:, :, z] = vol[:, :, lower[z]]
+            continue
+        slice = vol[:, :, lower[z]] * (1. - weights[z]) + vol[:, :, upper[z]] * weights[z]
+        if np.issubdtype(out.dtype, np.integer):
+            np.rint(slice, out=slice)
+        out[:, :, z] = slice
+    return out, new_positions
 
 
 # source code from keras.preprocessing.image
-def transform_matrix_offset_center(matrix, x, y):
-    o_x = float(x) / 2 + 0.5
-    o_y = float(y) / 2 + 0.5
-    offset_matrix = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
-    reset_matrix = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+def transform_matrix_offset_center(matrix, x, y, z=None):
+    # (3, 3) matrix for x, y, (4, 4) matrix for x, y, z
+    center = [float(size) / 2 + 0.5 for size in ((x, y) if z is None else (x, y, z))]
+    offset_matrix = np.eye(len(center) + 1)
+    offset_matrix[:-1, -1] = center
+    reset_matrix = np.eye(len(center) + 1)
+    reset_matrix[:-1, -1] = np.negative(center)
     transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
     return transform_matrix
 
@@ -55,10 +198,14 @@ def apply_transform(x, transform_matrix, channel_axis=0, fill_mode='nearest', cv
 
 
 # implemented helpers
-def normalize(x, v_min=-1024., v_max=800.):
-    x[x < v_min] = v_min
-    x[x > v_max] = v_max
-    return (x - v_min) / (v_max - v_min)
+@profiler.timed('normalize')
+def normalize(x, v_min=-1024., v_max=800., dtype=None, out=None, num_workers=1):
+    """
+    Clip x into [v_min, v_max] and scale it into [0, 1], by chunks. See intensity.normalize
+    :param dtype: dtype of the output. If None, float dtypes are kept and integer dtypes give float32
+    :param out: array to write into, e.g. x itself to normalize a float x in place. If None, a new array
+    """
+    return intensity.normalize(x, v_min, v_max, dtype=dtype, out=out, num_workers=num_workers)
 
 
 def flip_axis(x, axis):
@@ -103,6 +250,157 @@ def zoom(x, zx, zy):
     x = apply_transform(x, transform_matrix, 0, 'constant', constant_value)
     return x
 
+class Affine(object):
+    """
+    Builder composing flips, rotations, shifts, zooms and shears into one affine matrix,
+    so that the image is resampled once whatever the number of stacked operations.
+    The matrix maps output coordinates to input coordinates, as ndi.affine_transform.
+    Example:
+        x = Affine(x.shape).flip(0).rotate(theta).zoom(1.1, 0.9).apply(x)
+        patch = Affine(patch.shape[1:]).rotate(theta, axes=(0, 2)).shift(2, 0, -3).apply(patch, channel_axis=0)
+    """
+    def __init__(self, shape):
+        """
+        :param shape: spatial shape of the images, 2 axes for 2D or 3 axes for true 3D transforms
+        """
+        assert len(shape) in (2, 3), 'expected a 2D or 3D shape'
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.matrix = np.eye(self.ndim + 1)
+
+    def _compose(self, matrix, centered=True):
+        if centered:
+            matrix = transform_matrix_offset_center(matrix, *self.shape)
+        # the first operation applied to the image is the leftmost one, as the matrix pulls coordinates
+        self.matrix = np.dot(self.matrix, matrix)
+        return self
+
+    def _plane_matrix(self, plane, axes):
+        matrix = np.eye(self.ndim + 1)
+        matrix[np.ix_(axes, axes)] = plane
+        return matrix
+
+    def flip(self, axis):
+        matrix = np.eye(self.ndim + 1)
+        matrix[axis, axis] = -1
+        matrix[axis, -1] = self.shape[axis] - 1
+        return self._compose(matrix, centered=False)
+
+    def rotate(self, theta, axes=(0, 1)):
+        """
+        :param theta: angle in radians
+        :param axes: plane of the rotation
+        """
+        return self._compose(self._plane_matrix([[np.cos(theta), -np.sin(theta)],
+                                                 [np.sin(theta), np.cos(theta)]], axes))
+
+    def shift(self, *offsets):
+        matrix = np.eye(self.ndim + 1)
+        matrix[:-1, -1] = offsets
+        return self._compose(matrix, centered=False)
+
+    def zoom(self, *factors):
+        return self._compose(np.diag(list(factors) + [1.]))
+
+    def shear(self, angle, axes=(0, 1)):
+        """
+        :param angle: shear angle in radians, as keras
+        :param axes: plane of the shear
+        """
+        return self._compose(self._plane_matrix([[1, -np.sin(angle)],
+                                                 [0, np.cos(angle)]], axes))
+
+    def apply(self, x, channel_axis=None, order=1, fill_mode='constant', cval=constant_value, out=None):
+        """
+        Resample x once by the composed matrix
+        :param x: image of the spatial shape of the builder, with an optional channel axis
+        :param channel_axis: axis of the channels, None if x has no channel axis
+        :param order: order of the spline
+        :param out: optional array of the shape of x to write into
+        :return: transformed image
+        """
+        if out is None:
+            out = np.empty_like(x)
+        if channel_axis is None:
+            channels, out_channels = [x], [out]
+        else:
+            channels, out_channels = np.rollaxis(x, channel_axis, 0), np.rollaxis(out, channel_axis, 0)
+
+        if np.array_equal(self.matrix, np.eye(self.ndim + 1)):
+            out[...] = x
+            return out
+        matrix = self.matrix[:-1, :-1]
+        if np.count_nonzero(matrix - np.diag(np.diagonal(matrix))) == 0:
+            # zooms, flips and shifts only, ndi.affine_transform is faster with the diagonal
+            matrix = np.diagonal(matrix)
+        for x_channel, out_channel in zip(channels, out_channels):
+            ndi.affine_transform(x_channel, matrix, self.matrix[:-1, -1], output=out_channel, order=order,
+                                 mode=fill_mode, cval=cval)
+        return out
+
+
+def random_affine(shape, rng, flip_axes=(), rotation=0., rotation_axes=((0, 1),), shift=0., zoom=(1., 1.),
+                  shear=0.):
+    """
+    Affine of random parameters
+    :param shape: spatial shape of the images
+    :param rng: np.random.RandomState drawing the parameters
+    :param flip_axes: axes flipped with a probability of 0.5
+    :param rotation: angles in radians are drawn in [-rotation, rotation]
+    :param rotation_axes: planes of the rotations, one angle is drawn per plane
+    :param shift: shifts in voxels are drawn in [-shift, shift] along each axis
+    :param zoom: zoom factors are drawn in [zoom[0], zoom[1]] along each axis
+    :param shear: shear angle in radians is drawn in [-shear, shear], in the plane of the first two axes
+    :return: Affine
+    """
+    affine = Affine(shape)
+    for axis in flip_axes:
+        if rng.rand() < 0.5:
+            affine.flip(axis)
+    if rotation:
+        for axes in rotation_axes:
+            affine.rotate(rng.uniform(-rotation, rotation), axes)
+    if shift:
+        affine.shift(*rng.uniform(-shift, shift, len(shape)))
+    if zoom[0] != 1 or zoom[1] != 1:
+        affine.zoom(*rng.uniform(zoom[0], zoom[1], len(shape)))
+    if shear:
+        affine.shear(rng.uniform(-shear, shear))
+    return affine
+
+
+@profiler.timed('augment_batch')
+def augment_batch(batch, seed=None, num_workers=AUGMENT_WORKERS, out=None, order=1, fill_mode='constant',
+                  cval=constant_value, **params):
+    """
+    Random affine augmentation of a batch, one single resample per sample
+    The parameters of every sample are drawn upfront from one generator, so that the result for a
+    given seed does not depend on the number of threads. The samples are resampled on a thread pool,
+    scipy.ndimage releasing the GIL.
+    :param batch: (N, C, H, W) or (N, C, H, W, D) batch
+    :param seed: seed or np.random.RandomState drawing the parameters
+    :param num_workers: number of threads
+    :param out: optional array of the shape of batch to write into
+    :param params: ranges of the parameters, see random_affine
+    :return: augmented batch
+    """
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    affines = [random_affine(batch.shape[2:], rng, **params) for _ in range(len(batch))]
+    if out is None:
+        out = np.empty_like(batch)
+
+    def augment(i):
+        affines[i].apply(batch[i], channel_axis=0, order=order, fill_mode=fill_mode, cval=cval, out=out[i])
+
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(augment, range(len(batch))))
+    else:
+        for i in range(len(batch)):
+            augment(i)
+    return out
+
+
 # please implement the random_augmentation according to your problem
 # example:
 # def random_augmentation(x, choice):
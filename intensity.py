@@ -0,0 +1,170 @@
+""" Implementation of helpers to clip and scale CT intensities
+Whole volumes are processed by chunks of a few MB along the first axis, optionally on threads,
+in place or into a caller-supplied buffer, so that no full-size temporary is allocated.
+
+Additional libraries:
+    numpy
+    futures (python2 only)
+
+Summary of available functions:
+    window_lut: lookup table mapping a 8 or 16 bits integer dtype into uint8 for a window
+    window_slice: map a slice into uint8 for a window
+    clip: clip a volume into a window, in place by default
+    normalize: clip and scale a volume into [0, 1] as float or [0, 255] as uint8
+    crop_normalize: crop, clip and scale sub-volumes in one pass, as bbox.create_subvols
+"""
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import bbox as B
+
+CHUNK_MB = 4  # size of the chunks of the input, about the size of the cache
+
+
+def window_lut(low, high, dtype):
+    """
+    Lookup table mapping every value of a 8 or 16 bits integer dtype into uint8 for window [low, high]
+    :return: lookup table indexed by the values viewed as unsigned, None for other dtypes
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iu' or dtype.itemsize > 2:
+        return None
+    values = np.arange(2 ** (8 * dtype.itemsize), dtype=np.int64).astype('u%d' % dtype.itemsize).view(dtype)
+    return window_slice(values, low, high)
+
+
+def window_slice(slice, low, high, lut=None):
+    """
+    Map a slice into uint8 for window [low, high]
+    :param slice: 2D array
+    :param lut: optional, lookup table of window_lut for the dtype of slice
+    :return: uint8 slice
+    """
+    if lut is not None:
+        return lut[slice.view('u%d' % slice.dtype.itemsize)]
+    out = np.clip(slice, low, high).astype(np.float32)
+    out -= low
+    out *= 255. / (high - low)
+    out += 0.5
+    return out.astype(np.uint8)
+
+
+def _bounds(dtype, v_min, v_max):
+    # python scalars of the dtype, so that clipping an integer array into itself needs no cast
+    if np.dtype(dtype).kind in 'iu':
+        return int(np.ceil(v_min)), int(np.floor(v_max))
+    return float(v_min), float(v_max)
+
+
+def _map_chunks(func, x, num_workers, chunk_mb):
+    """
+    Call func(start, stop) for chunks [start, stop) of the first axis of x
+    """
+    if x.ndim == 0 or len(x) == 0:
+        return
+    rows = max(1, int(chunk_mb * 1024 ** 2 // max(1, x[0].nbytes)))
+    chunks = [(start, min(start + rows, len(x))) for start in range(0, len(x), rows)]
+    if num_workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for job in [executor.submit(func, start, stop) for start, stop in chunks]:
+                job.result()
+    else:
+        for start, stop in chunks:
+            func(start, stop)
+
+
+def clip(x, v_min=-1024., v_max=800., out=None, num_workers=1, chunk_mb=CHUNK_MB):
+    """
+    Clip x into [v_min, v_max]
+    :param out: array to write into, x itself if None
+    :param num_workers: number of threads
+    :return: out
+    """
+    if out is None:
+        out = x
+    v_min, v_max = _bounds(out.dtype, v_min, v_max)
+
+    def clip_chunk(start, stop):
+        np.clip(x[start:stop], v_min, v_max, out=out[start:stop])
+
+    _map_chunks(clip_chunk, x, num_workers, chunk_mb)
+    return out
+
+
+def normalize(x, v_min=-1024., v_max=800., dtype=None, out=None, num_workers=1, chunk_mb=CHUNK_MB):
+    """
+    Clip x into [v_min, v_max] and scale it into [0, 1] for float dtypes, or [0, 255] for uint8
+    8 and 16 bits integer inputs are mapped into uint8 through a lookup table.
+    :param x: array, e.g. a (y, x, z) volume or a memory map
+    :param dtype: dtype of the output, a float dtype or uint8. If None, the dtype of out, else float dtypes
+                  are kept and integer dtypes give float32
+    :param out: array to write into, e.g. x itself to normalize a float x in place. If None, a new array
+    :param num_workers: number of threads
+    :return: out
+    """
+    if dtype is None:
+        if out is not None:
+            dtype = out.dtype
+        else:
+            dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float32
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f' and dtype != np.uint8:
+        # [0, 1] would be rounded to 0 and 1
+        raise ValueError('normalize outputs float or uint8, not %s' % dtype)
+    if out is None:
+        out = np.empty(x.shape, dtype=dtype)
+    elif out.dtype != dtype:
+        raise ValueError('out has dtype %s, expected %s' % (out.dtype, dtype))
+
+    low, high = float(v_min), float(v_max)
+    if dtype == np.uint8:
+        lut = window_lut(low, high, x.dtype)
+        scale = 255. / (high - low)
+    else:
+        lut = None
+        scale = 1. / (high - low)
+
+    def normalize_chunk(start, stop):
+        src, dst = np.asarray(x[start:stop]), out[start:stop]
+        if lut is not None:
+            np.take(lut, src.view('u%d' % src.dtype.itemsize), out=dst, mode='clip')
+        elif dtype.kind == 'f':
+            np.clip(src, low, high, out=dst, casting='unsafe')
+            dst -= low
+            dst *= scale
+        else:
+            # uint8 output from float input, through a float32 buffer of the chunk
+            buf = np.clip(src, low, high).astype(np.float32, copy=False)
+            buf -= low
+            buf *= scale
+            buf += 0.5
+            np.copyto(dst, buf, casting='unsafe')
+
+    _map_chunks(normalize_chunk, x, num_workers, chunk_mb)
+    return out
+
+
+def crop_normalize(vol, bboxes, v_min=-1024., v_max=800., dtype=np.float32, padding_value=None, out=None):
+    """
+    Crop sub-volumes as bbox.create_subvols and clip and scale them as normalize, in one pass:
+    only the valid region of each box is read from vol and written scaled into the output.
+    :param vol: given volume, e.g. a memory map
+    :param bboxes: (6,) bounding box or (N, 6) bounding boxes of the same size
+    :param padding_value: value to pad, in the unit of vol. v_min if None
+    :param out: optional array of the output shape and dtype to write into
+    :return: (d0, d1, d2) or (N, d0, d1, d2) scaled sub-volumes
+    """
+    dtype = np.dtype(dtype)
+    single = np.ndim(bboxes) == 1
+    bboxes = B.regularize(np.reshape(bboxes, (-1, 6)))
+    if padding_value is None:
+        padding_value = v_min
+    padding = normalize(np.array([padding_value], dtype=np.float64), v_min, v_max, dtype=dtype)[0]
+
+    if out is None:
+        size = tuple(bboxes[0, 3:6] - bboxes[0, 0:3]) if len(bboxes) else (0, 0, 0)
+        out = np.empty(size if single else (len(bboxes),) + size, dtype=dtype)
+    B.create_subvols(vol, bboxes, padding_value=padding, out=out[np.newaxis] if single else out,
+                     copy=lambda src, dst: normalize(src, v_min, v_max, out=dst))
+    return out
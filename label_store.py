@@ -0,0 +1,221 @@
+""" Indexed store of the nodule labels of label_bbox_malignancy.json
+The json file, {patient: {'folder': ..., nodule: {'bbox': [...], 'Docmalignancy': ...}}}, is converted
+once into a SQLite database next to it, and converted again only when the json file changes.
+Fetching a patient reads its nodules only, as ready-made arrays, and nodules are selected by
+malignancy and diameter through indices, without loading the whole dataset.
+
+The diameter of a nodule is its 'diameter' field if any, else the largest extent of its box.
+
+Usage:
+    labels = open_store('label_bbox_malignancy.json')
+    nodules = labels.get('CT590466')  # dict(names, bboxes (N, 6), malignancy (N,), diameter (N,))
+    malignant = labels.query(malignancy=(0.5, None), diameter=(3., 30.))
+
+    python label_store.py label_bbox_malignancy.json
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+STORE_VERSION = 1
+MALIGNANCY_THRESHOLD = 0.5  # nodules above it are displayed as malignant
+
+_SCHEMA = [
+    'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE patients (patient TEXT PRIMARY KEY, folder TEXT)',
+    'CREATE TABLE nodules (patient TEXT, rank INTEGER, name TEXT, min0 REAL, min1 REAL, min2 REAL, '
+    'max0 REAL, max1 REAL, max2 REAL, malignancy REAL, diameter REAL, attributes TEXT)',
+    'CREATE UNIQUE INDEX nodules_patient ON nodules (patient, rank)',
+    'CREATE INDEX nodules_malignancy ON nodules (malignancy, diameter)',
+    'CREATE INDEX nodules_diameter ON nodules (diameter)',
+]
+_COLUMNS = 'patient, name, min0, min1, min2, max0, max1, max2, malignancy, diameter'
+
+
+def _source_stamp(json_path):
+    stat = os.stat(json_path)
+    return '%d:%d' % (stat.st_size, int(stat.st_mtime * 1e6))
+
+
+def _nodule_rows(label):
+    """
+    Rows of the nodules table, from the parsed json
+    """
+    for patient, nodules in label.items():
+        rank = 0
+        for name, nodule in nodules.items():
+            if name == 'folder' or not isinstance(nodule, dict):
+                continue
+            bbox = [float(v) for v in nodule['bbox']]
+            diameter = nodule.get('diameter')
+            if diameter is None:
+                diameter = max(bbox[3] - bbox[0], bbox[4] - bbox[1], bbox[5] - bbox[2])
+            malignancy = nodule.get('Docmalignancy')
+            attributes = dict((key, value) for key, value in nodule.items()
+                              if key not in ('bbox', 'Docmalignancy', 'diameter'))
+            yield ([patient, rank, name] + bbox +
+                   [None if malignancy is None else float(malignancy), float(diameter), json.dumps(attributes)])
+            rank += 1
+
+
+def build_store(json_path, store_path):
+    """
+    Convert a label json file into a store, written into a temporary file renamed once complete
+    """
+    with open(json_path, 'r') as f:
+        label = json.load(f, object_pairs_hook=OrderedDict)
+
+    tmp_path = '%s.%d.tmp' % (store_path, os.getpid())
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    try:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            connection.executemany('INSERT INTO meta VALUES (?, ?)',
+                                   [('version', str(STORE_VERSION)), ('source', _source_stamp(json_path))])
+            connection.executemany('INSERT INTO patients VALUES (?, ?)',
+                                   [(patient, nodules.get('folder')) for patient, nodules in label.items()])
+            connection.executemany('INSERT INTO nodules VALUES (%s)' % ', '.join(['?'] * 12), _nodule_rows(label))
+            connection.commit()
+        finally:
+            connection.close()
+        if os.path.isfile(store_path):
+            os.remove(store_path)  # os.rename does not replace a file on windows
+        os.rename(tmp_path, store_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def _is_current(json_path, store_path):
+    if not os.path.isfile(store_path):
+        return False
+    try:
+        connection = sqlite3.connect(store_path)
+        try:
+            meta = dict(connection.execute('SELECT key, value FROM meta'))
+        finally:
+            connection.close()
+    except sqlite3.DatabaseError:
+        return False
+    return meta.get('version') == str(STORE_VERSION) and meta.get('source') == _source_stamp(json_path)
+
+
+def open_store(json_path, store_path=None):
+    """
+    Store of a label json file, converted if missing or older than the json file
+    :param store_path: path of the store, json_path with the extension .sqlite if None
+    :return: LabelStore
+    """
+    if store_path is None:
+        store_path = os.path.splitext(json_path)[0] + '.sqlite'
+    if not _is_current(json_path, store_path):
+        build_store(json_path, store_path)
+    return LabelStore(store_path)
+
+
+def _nodule_arrays(rows):
+    """
+    :return: dict(patients, names, bboxes, malignancy, diameter) of rows of _COLUMNS, nan for a missing malignancy
+    """
+    values = np.array([row[2:] for row in rows], dtype=np.float64).reshape(-1, 8)
+    return dict(patients=[row[0] for row in rows], names=[row[1] for row in rows], bboxes=values[:, 0:6],
+                malignancy=values[:, 6], diameter=values[:, 7])
+
+
+class LabelStore(object):
+    """
+    Read-only access to a store of build_store
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+
+    def __contains__(self, patient):
+        return self.connection.execute('SELECT 1 FROM patients WHERE patient = ?', (patient,)).fetchone() is not None
+
+    def patients(self):
+        return [row[0] for row in self.connection.execute('SELECT patient FROM patients ORDER BY patient')]
+
+    def folder(self, patient):
+        row = self.connection.execute('SELECT folder FROM patients WHERE patient = ?', (patient,)).fetchone()
+        if row is None:
+            raise KeyError(patient)
+        return row[0]
+
+    def get(self, patient):
+        """
+        Nodules of a patient, in the order of the json file
+        :return: dict(names, bboxes, malignancy, diameter), (N, 6) boxes and (N,) vectors
+        """
+        if patient not in self:
+            raise KeyError(patient)
+        nodules = _nodule_arrays(self.connection.execute(
+            'SELECT %s FROM nodules WHERE patient = ? ORDER BY rank' % _COLUMNS, (patient,)).fetchall())
+        del nodules['patients']
+        return nodules
+
+    __getitem__ = get
+
+    def attributes(self, patient):
+        """
+        :return: the other fields of the nodules of a patient in the json file, list of dict
+        """
+        return [json.loads(row[0]) for row in self.connection.execute(
+            'SELECT attributes FROM nodules WHERE patient = ? ORDER BY rank', (patient,))]
+
+    def query(self, malignancy=None, diameter=None, patients=None):
+        """
+        Nodules of the whole store in ranges, e.g. malignancy=(0.5, None) for all malignancies > 0.5
+        :param malignancy: optional (low, high) range, low < malignancy <= high, None for no bound
+        :param diameter: optional (low, high) range, low < diameter <= high, None for no bound
+        :param patients: optional list of patients to search
+        :return: dict(patients, names, bboxes, malignancy, diameter), by patient and order of the json file
+        """
+        conditions, params = [], []
+        for column, bounds in (('malignancy', malignancy), ('diameter', diameter)):
+            if bounds is None:
+                continue
+            low, high = bounds
+            if low is not None:
+                conditions.append('%s > ?' % column)
+                params.append(float(low))
+            if high is not None:
+                conditions.append('%s <= ?' % column)
+                params.append(float(high))
+        if patients is not None:
+            patients = list(patients)
+            conditions.append('patient IN (%s)' % ', '.join(['?'] * len(patients)))
+            params.extend(patients)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return _nodule_arrays(self.connection.execute(
+            'SELECT %s FROM nodules%s ORDER BY patient, rank' % (_COLUMNS, where), params).fetchall())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a label json file into an indexed store')
+    parser.add_argument('json_file', type=str)
+    parser.add_argument('--store', type=str, default=None, help='path of the store, .sqlite next to the json if None')
+    args = parser.parse_args()
+
+    with open_store(args.json_file, args.store) as labels:
+        print('%d patients in %s' % (len(labels), labels.path))
@@ -1,121 +1,138 @@
-import json
 import os
 import numpy as np
-import pydicom as dicom
 import SimpleITK as sitk
 import re
 import random
+import crawler
+import dicom_io
+from image import resample_slices
+import label_store
+import profiler
 from viewer import vis_slice, view_scan
 
+@profiler.timed('SearchDir')
 def SearchDir(dirname):
     """
     :param initial path of directory:
-    :return the path saved the CT dicom files.:
+    :return the path saved the CT dicom files, i.e. the first series found by crawler.crawl.:
     """
-    dirlist = os.listdir(dirname)
-    dirlist = [item for item in dirlist if os.path.isdir(os.path.join(dirname,item))]
-    lengthOfFile = len(os.listdir(dirname)) - len(dirlist)
-    allFile = all([os.path.isfile('/'.join([dirname, name])) for name in os.listdir(dirname)])
-    if (lengthOfFile > 100) & allFile:
-        return dirname
-    elif allFile:
+    series = crawler.crawl(dirname, num_workers=1, read_uid=False)
+    if not series:
         return False
-    else:
-        for folderName in dirlist:
-            filename = '/'.join([dirname, folderName])
-            temp = SearchDir(filename)
-            if type(temp) == str:
-                return temp
-            else:
-                pass
-def loadDicom(dir):
+    return series[0]['path']
+
+
+@profiler.timed('loadDicom')
+def loadDicom(dir, backend='sitk', dtype=np.int16, use_cache=True):
     """
     load the CT image sequences.
-    :param dir: path of folder save the CT images.
-    :return: the CT three dimenal voxel array.
+    :param dir: path of folder save the CT images, or a series of the index returned by crawler.crawl,
+                its stack if any selecting one stack of the folder.
+    :param backend: 'sitk' to read with SimpleITK, 'threads' to decode the slices in parallel
+                    into a preallocated volume
+    :param dtype: dtype of the volume, np.int16 keeps the native HU data, np.float32 is optional
+    :param use_cache: False to read the headers again without saving them, see dicom_io.scan_series
+    :return: the CT three dimenal voxel array, False if the folder has no series or no slice.
+    A folder mixing several series or stacks is split by dicom_io.split_stacks and its largest stack is
+    loaded, the one of the series uid of dir if given, or the stack of dir given by crawler.split_series.
+    Duplicated slices are dropped and a stack with gaps or irregular steps is resampled along z at its
+    median step. image_dict['slice_check'] reports it.
     """
-    DicomDir = SearchDir(dir)
-    spacingList = []
-    positionList =[]
-    names = os.listdir(DicomDir)
-    names = [ x for x in names if '.dcm' in x]
-    for i, item in enumerate(names):
-        fileName = os.path.join(DicomDir,item)
-        imInfo= dicom.read_file(fileName, stop_before_pixels=True)
-        positionList += [float(imInfo.ImagePositionPatient[2])]
-    positionList = np.sort(np.array(positionList))
-    try:
+    if isinstance(dir, dict):
+        DicomDir = dir['path']
+    else:
+        DicomDir = SearchDir(dir)
+        if DicomDir is False:
+            return False
+    with profiler.timer('scan_series'):
+        header = dicom_io.scan_series(DicomDir, use_cache=use_cache)
+    with profiler.timer('spacing_check'):
+        stacks = dicom_io.split_stacks(header)
+    if not stacks:
+        return False
+    if isinstance(dir, dict) and dir.get('stack') is not None:
+        stack_index = dir['stack']
+        if stack_index >= len(stacks) or stacks[stack_index]['series_uid'] != dir.get('series_uid'):
+            raise ValueError('stack %d of %s not found, the folder changed since the crawl' % (stack_index, DicomDir))
+    else:
+        series_uid = dir.get('series_uid') if isinstance(dir, dict) else None
+        stack_index = next((k for k, stack in enumerate(stacks) if stack['series_uid'] == series_uid), 0)
+    stack = stacks[stack_index]
+    profiler.count('slices', len(stack['indices']))
 
-        for i in range(1, len(positionList)):
-            temp = positionList[i] - positionList[0]
-            temp = abs(temp) / abs((positionList[1] - positionList[0]))
-            assert(abs(temp - round(temp))<1.0e-4)
+    if backend == 'threads':
+        with profiler.timer('read_series'):
+            image_dict = dicom_io.read_series(DicomDir, dicom_io.subset_header(header, stack['indices']),
+                                              dtype=dtype)
+    else:
+        # the files are already sorted by position, no need for GDCM to parse the headers again
+        reader = sitk.ImageSeriesReader()
+        dicom_names = [os.path.join(DicomDir, header['names'][i]) for i in stack['indices']]
+        reader.SetFileNames(dicom_names)
+        with profiler.timer('sitk_execute'):
+            image = reader.Execute()
 
-    except:
-        print(DicomDir)
-        return False
-       
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(DicomDir)
-    reader.SetFileNames(dicom_names)
-    image = reader.Execute()
+        with profiler.timer('to_array'):
+            image_array = sitk.GetArrayFromImage(image) #zyx
+            image_array = np.moveaxis(image_array, 0, -1) #yxz
+            if np.issubdtype(image_array.dtype, np.floating) and np.issubdtype(dtype, np.integer):
+                # rounded and clipped as the threads backend, a bare cast would truncate toward zero
+                limits = np.iinfo(dtype)
+                image_array = np.clip(np.rint(image_array), limits.min, limits.max, out=image_array)
+            image_array = image_array.astype(dtype, copy=False)
+        origin = image.GetOrigin()  # xyz
+        origin = (origin[1], origin[0], origin[2])  # yxz
+        spacing = image.GetSpacing()  # xyz
+        spacing = (spacing[1], spacing[0], spacing[2])  # yxz
+        listDirection = list(image.GetDirection())
+        assert len(listDirection) == 9
+        assert all(listDirection[i] == 0.0 for i in range(len(listDirection)) if i not in [0, 4, 8])
+        numpyDirection = np.array([listDirection[4], listDirection[0], listDirection[8]])
+        # sumDirection = numpyDirection.sum()
+        image_dict = dict(array=image_array, origin=origin, spacing=spacing, direction=numpyDirection)
 
-    image_array = sitk.GetArrayFromImage(image) #zyx
-    image_array = np.moveaxis(image_array, 0, -1) #yxz
-    image_array = image_array.astype(np.float)
-    origin = image.GetOrigin()  # xyz
-    origin = (origin[1], origin[0], origin[2])  # yxz
-    spacing = image.GetSpacing()  # xyz
-    spacing = (spacing[1], spacing[0], spacing[2])  # yxz
-    listDirection = list(image.GetDirection())
-    assert len(listDirection) == 9
-    assert all(listDirection[i] == 0.0 for i in range(len(listDirection)) if i not in [0, 4, 8])
-    numpyDirection = np.array([listDirection[4], listDirection[0], listDirection[8]])
-    # sumDirection = numpyDirection.sum()
-    image_dict = dict(array=image_array, origin=origin, spacing=spacing, direction=numpyDirection)
+    if not stack['uniform']:
+        image_dict['array'], _ = resample_slices(image_dict['array'], stack['positions'], stack['spacing'])
+        image_dict['spacing'] = tuple(image_dict['spacing'][0:2]) + (stack['spacing'],)
+        profiler.count('resampled_series')
+    image_dict['slice_check'] = dict(stacks=len(stacks), stack=stack_index, series_uid=stack['series_uid'],
+                                     slices=len(stack['indices']),
+                                     duplicates=stack['duplicates'], gaps=stack['gaps'],
+                                     resampled=not stack['uniform'])
 
-    if not hasattr(imInfo, 'PatientAge') or imInfo.PatientAge is '':
+    age = re.findall(r"[1-9]\d+", str(header['age']))
+    if not age:
         image_dict['age'] = random.randint(50, 70)
     else:
-        image_dict['age'] = int(re.findall(r"[1-9]\d+", imInfo.PatientAge)[0])
-
+        image_dict['age'] = int(age[0])
 
-    if not hasattr(imInfo, 'sex') or imInfo.PatientSex is '':
-        image_dict['sex'] = random.randint(0, 1)
-    elif imInfo.PatientSex is 'F':
+    sex = str(header['sex'])
+    if sex == 'F':
         image_dict['sex'] = 0
-    elif imInfo.PatientSex is 'M':
+    elif sex == 'M':
         image_dict['sex'] = 1
+    else:
+        image_dict['sex'] = random.randint(0, 1)
 
 
     # with open('some.csv', 'w', newline='') as f:
     #     writer = csv.writer(f)
     #     writer.writerows(image_array[0])
-    print('age and sex ', image_dict['age'], image_dict['sex'])
     return image_dict
 
 if __name__ == '__main__':
     folder = SearchDir('/Users/sunanlan/Downloads/viewer 2')
     im_dict = loadDicom(folder)
     # print(im_dict)
-    with open('label_bbox_malignancy.json', 'r') as f:
-        label = json.load(f)
-    bboxlist = []
-    attr_list = []
-    color_list = []
+    labels = label_store.open_store('label_bbox_malignancy.json')
     patientName = 'CT590466'
-    for item in label[patientName]:
-        if item != 'folder':
-            nodule = label['CT590466'][item]
-            # bboxlist.append([nodule['bbox'][4], nodule['bbox'][3], nodule['bbox'][1], nodule['bbox'][0], nodule['bbox'][2], nodule['bbox'][5]])
-            bboxlist.append(nodule['bbox'])
-            if (nodule['Docmalignancy']>0.5) == True:
-                attr_list.append(1)
-                color_list.append('red')
-            else:
-                attr_list.append(0)
-                color_list.append('green')
+    nodules = labels.get(patientName)
+    bboxlist = nodules['bboxes']
+    attr_list = (nodules['malignancy'] > label_store.MALIGNANCY_THRESHOLD).astype(int).tolist()
+    color_list = ['red' if attr else 'green' for attr in attr_list]
 
-        # vis_slice(im_dict['array'][:,:,int(nodule['position'][2])], )
-    view_scan(im_dict['array'][:,:,::-1], bboxlist, attr_list, color_list, patientName=patientName)
+    view_scan(im_dict['array'][:,:,::-1], bboxlist, attr_list, color_list, patientName=patientName,
+              spacing=im_dict['spacing'])
+    if profiler.is_enabled():
+        print(profiler.summary())
     print('finished')
@@ -0,0 +1,200 @@
+""" Stage timers and counters of the load, pre-processing and viewing pipeline
+The instrumentation is off by default: timer returns a shared no-op context manager and count
+returns at once, so that the instrumented code only pays a global lookup per stage. Once enabled,
+the stages nest as they are entered, per thread, and every path of stages accumulates its calls
+and its time. The breakdown is dumped as json, as an indented flame-style summary, or as folded
+stacks for flamegraph.pl.
+
+Setting the environment variable PIPELINE_PROFILE enables it at import.
+
+Usage:
+    import profiler
+    profiler.enable()
+    image_dict = main.loadDicom(dicom_dir)
+    print(profiler.summary())
+    profiler.dump('timing.json', case='CT590466')
+
+    with profiler.timer('my_stage'):
+        ...
+
+    @profiler.timed('my_function')
+    def my_function():
+        ...
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PROFILE_ENV = 'PIPELINE_PROFILE'  # environment variable enabling the instrumentation at import
+SEPARATOR = ';'  # separator of the stages of a path, as in the folded stacks of flamegraph.pl
+
+_clock = getattr(time, 'perf_counter', time.time)
+_enabled = bool(os.environ.get(PROFILE_ENV))
+_lock = threading.Lock()
+_local = threading.local()
+_stages = OrderedDict()  # path -> [calls, total seconds], in order of first entry
+_counters = OrderedDict()
+
+
+def enable(reset=True):
+    """
+    :param reset: clear the stages and counters recorded so far
+    """
+    global _enabled
+    if reset:
+        clear()
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.name)
+        self.path = SEPARATOR.join(stack)
+        if self.path not in _stages:
+            with _lock:
+                _stages.setdefault(self.path, [0, 0.])
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = _clock() - self.start
+        _local.stack.pop()
+        with _lock:
+            stage = _stages.setdefault(self.path, [0, 0.])
+            stage[0] += 1
+            stage[1] += elapsed
+        return False
+
+
+def timer(name):
+    """
+    Context manager timing a stage, nested under the stages entered by the current thread
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name=None):
+    """
+    Decorator timing every call of a function as a stage
+    :param name: name of the stage, the name of the function if None
+    """
+    def decorator(func):
+        stage = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Add value to a counter, e.g. a number of slices or of cache misses
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def report():
+    """
+    :return: dict(stages, counters), stages being a list of dict(path, calls, total, self) in order of first
+             entry, in seconds, self excluding the time of the nested stages
+    """
+    with _lock:
+        stages = [(path, calls, total) for path, (calls, total) in _stages.items()]
+        counters = OrderedDict(_counters)
+    nested = dict()
+    for path, _, total in stages:
+        parent = path.rpartition(SEPARATOR)[0]
+        nested[parent] = nested.get(parent, 0.) + total
+    return dict(stages=[dict(path=path, calls=calls, total=total, self=max(0., total - nested.get(path, 0.)))
+                        for path, calls, total in stages],
+                counters=counters)
+
+
+def dump(path, **info):
+    """
+    Save the report as json
+    :param info: additional fields, e.g. the name of the case
+    """
+    result = OrderedDict(info)
+    result.update(report())
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+def folded():
+    """
+    Folded stacks of flamegraph.pl, one line 'stage;nested stage microseconds' per path, on the self time
+    """
+    return '\n'.join('%s %d' % (stage['path'], int(round(1e6 * stage['self']))) for stage in report()['stages'])
+
+
+def summary(width=20):
+    """
+    Flame-style summary: one line per stage, indented under its parent, with its total time, a bar of its
+    share of the root stage, its self time and its calls, then the counters
+    """
+    rep = report()
+    children = OrderedDict()
+    for stage in rep['stages']:
+        children.setdefault(stage['path'].rpartition(SEPARATOR)[0], []).append(stage)
+
+    lines = []
+
+    def add(stage, depth, root_total):
+        share = stage['total'] / max(root_total, 1e-12)
+        lines.append('%-40s %10.1fms %-*s %5.1f%%  self %8.1fms  calls %d' % (
+            '  ' * depth + stage['path'].rpartition(SEPARATOR)[2], 1000 * stage['total'], width,
+            '#' * int(round(width * share)), 100 * share, 1000 * stage['self'], stage['calls']))
+        for child in children.get(stage['path'], []):
+            add(child, depth + 1, root_total)
+
+    for root in children.get('', []):
+        add(root, 0, root['total'])
+    for name, value in rep['counters'].items():
+        lines.append('%-40s %10s' % (name, value))
+    return '\n'.join(lines) if lines else 'no stage'
@@ -0,0 +1,97 @@
+""" Store of detection results indexed by series uid
+The predictions of a whole test set are saved in one file of easy_io.write_bin_file: the (K, 5)
+arrays [confidence, dim0, dim1, dim2, diameter] of all series are concatenated, each series being
+contiguous and sorted by increasing confidence. Opening the store memory-maps them, so that reading
+one series costs only that series, and a confidence threshold is a binary search.
+
+Usage:
+    python results_store.py /path/to/test_result.ckpt /path/to/test_result.bin
+"""
+
+import argparse
+
+import numpy as np
+
+import easy_io
+
+STORE_VERSION = 1
+
+
+def write_results(path, result_dict, overwrite='overwrite'):
+    """
+    Save the results of a test set
+    :param path: path of the store
+    :param result_dict: dict of series uid -> (K, 5) predictions [confidence, dim0, dim1, dim2, diameter]
+    :param overwrite: policy if the file exists, see easy_io.OVERWRITE_POLICIES
+    :return: whether the file was written
+    """
+    uids = sorted(result_dict)
+    predictions = [np.reshape(np.asarray(result_dict[uid], dtype=np.float32), (-1, 5)) for uid in uids]
+    predictions = [pred[np.argsort(pred[:, 0], kind='mergesort')] for pred in predictions]
+    offsets = np.concatenate([[0], np.cumsum([len(pred) for pred in predictions])]).astype(np.int64)
+    return easy_io.write_bin_file(path, dict(version=STORE_VERSION, uids=np.array(uids, dtype=str), offsets=offsets,
+                                             predictions=np.concatenate(predictions + [np.zeros((0, 5), np.float32)])),
+                                  overwrite=overwrite)
+
+
+class ResultsStore(object):
+    """
+    Read-only view of a store of write_results
+    """
+    def __init__(self, path):
+        data = easy_io.read_bin_file(path)
+        if data.get('version') != STORE_VERSION:
+            raise IOError('"%s" is not a results store of version %d' % (path, STORE_VERSION))
+        self.uids = data['uids']
+        self.offsets = data['offsets']
+        self.predictions = data['predictions']
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __contains__(self, uid):
+        return self._index(uid) is not None
+
+    def _index(self, uid):
+        index = np.searchsorted(self.uids, uid)
+        if index < len(self.uids) and self.uids[index] == uid:
+            return index
+        return None
+
+    def get(self, uid, conf_threshold=None):
+        """
+        Predictions of a series
+        :param conf_threshold: optional, only the predictions with a confidence >= conf_threshold are returned
+        :return: (K, 5) view of the predictions, sorted by increasing confidence
+        """
+        index = self._index(uid)
+        if index is None:
+            raise KeyError(uid)
+        pred = self.predictions[self.offsets[index]:self.offsets[index + 1]]
+        if conf_threshold is not None:
+            pred = pred[np.searchsorted(pred[:, 0], conf_threshold, side='left'):]
+        return pred
+
+    __getitem__ = get
+
+    def keys(self):
+        return [str(uid) for uid in self.uids]
+
+
+def convert_torch_results(result_file, path, overwrite='overwrite'):
+    """
+    Convert a result checkpoint of torch.save, with a 'result_dict' of uid -> predictions, into a store
+    """
+    import torch
+
+    result_dict = torch.load(result_file)['result_dict']
+    return write_results(path, dict((uid, np.asarray(pred)) for uid, pred in result_dict.items()), overwrite)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a result checkpoint into a results store')
+    parser.add_argument('result_file', type=str)
+    parser.add_argument('store', type=str)
+    args = parser.parse_args()
+
+    convert_torch_results(args.result_file, args.store)
@@ -0,0 +1,274 @@
+""" Multi-process sampler of training patches
+Worker processes draw positive patches around the nodules (nodule_voxel_coord) and random negative
+patches from memory-mapped volumes. They crop, clip and scale them (intensity.crop_normalize, on top
+of bbox.create_subvols and image.normalize), augment them (image.augment_batch) and write whole
+batches into slots of shared memory. Only slot indices and timings go through the queues, the
+arrays are never pickled.
+
+Usage:
+    sampler = PatchSampler(data_dir, label_dir, patch_size=32, batch_size=64, num_workers=8)
+    with sampler:
+        for patches, labels in sampler:
+            ...  # patches and labels are views of a slot, valid until the next batch
+    print(sampler.report())
+
+    python sampler.py /path/to/npy_data_zoomed/train /path/to/npy_nodule_mask_zoomed/train --workers 8
+"""
+
+import argparse
+import ctypes
+import os
+import time
+from collections import OrderedDict
+from multiprocessing import Process, Queue, RawArray, cpu_count
+
+import numpy as np
+
+import bbox as B
+import image
+import intensity
+
+NUM_SLOTS_PER_WORKER = 2  # batches each worker can have ready in advance
+MMAP_CACHE_SIZE = 64  # number of memory-mapped volumes kept open by each worker
+NEGATIVE_TRIALS = 10  # draws of a negative center before accepting one inside a nodule
+
+# default augmentation, see image.random_affine
+AUGMENTATION = dict(flip_axes=(0, 1, 2), rotation=np.pi / 12, shift=2, zoom=(0.9, 1.1))
+
+
+def list_scans(data_dir, label_dir):
+    """
+    Scans of data_dir having a label file
+    :return: list of dict(name, data_file, coords, diameters)
+    """
+    scans = []
+    for data_file in sorted(os.listdir(data_dir)):
+        name = os.path.splitext(data_file)[0]
+        label_file = os.path.join(label_dir, name + '.npz')
+        if not data_file.endswith('.npy') or not os.path.isfile(label_file):
+            continue
+        with np.load(label_file) as labels:
+            coords = np.reshape(labels['nodule_voxel_coord'], (-1, 3)).astype(np.float64)
+            diameters = np.reshape(labels['nodule_voxel_diameter'], (-1,)).astype(np.float64)
+        scans.append(dict(name=name, data_file=os.path.join(data_dir, data_file), coords=coords,
+                          diameters=diameters))
+    return scans
+
+
+class _Slots(object):
+    """
+    Batches of patches and labels in shared memory, as numpy views
+    """
+    def __init__(self, num_slots, batch_size, patch_size, raw_patches=None, raw_labels=None):
+        self.shape = (num_slots, batch_size, 1, patch_size, patch_size, patch_size)
+        num_patches = num_slots * batch_size
+        if raw_patches is None:
+            raw_patches = RawArray(ctypes.c_float, num_patches * patch_size ** 3)
+            raw_labels = RawArray(ctypes.c_int8, num_patches)
+        self.raw_patches, self.raw_labels = raw_patches, raw_labels
+        self.patches = np.ctypeslib.as_array(self.raw_patches).reshape(self.shape)
+        self.labels = np.ctypeslib.as_array(self.raw_labels).reshape(self.shape[0:2])
+
+
+class _Worker(object):
+    """
+    State of a worker process: its generator, its open volumes and its augmentation buffer
+    """
+    def __init__(self, scans, slots, patch_size, pos_fraction, jitter, v_min, v_max, augmentation, seed):
+        self.scans = scans
+        self.slots = slots
+        self.patch_size = patch_size
+        self.pos_fraction = pos_fraction
+        self.jitter = jitter
+        self.v_min, self.v_max = v_min, v_max
+        self.augmentation = augmentation
+        self.rng = np.random.RandomState(seed)
+        self.volumes = OrderedDict()
+        self.positive_scans = [i for i, scan in enumerate(scans) if len(scan['coords'])]
+        self.buffer = np.empty(slots.shape[1:], dtype=np.float32) if augmentation else None
+
+    def volume(self, scan_id):
+        vol = self.volumes.pop(scan_id, None)
+        if vol is None:
+            vol = np.load(self.scans[scan_id]['data_file'], mmap_mode='r')
+            if len(self.volumes) >= MMAP_CACHE_SIZE:
+                self.volumes.popitem(last=False)
+        self.volumes[scan_id] = vol
+        return vol
+
+    def draw(self):
+        """
+        Draw the center of one patch
+        :return: scan id, center, label
+        """
+        if self.positive_scans and self.rng.rand() < self.pos_fraction:
+            scan_id = self.positive_scans[self.rng.randint(len(self.positive_scans))]
+            coords = self.scans[scan_id]['coords']
+            center = coords[self.rng.randint(len(coords))] + self.rng.uniform(-self.jitter, self.jitter, 3)
+            return scan_id, center, 1
+
+        scan_id = self.rng.randint(len(self.scans))
+        scan = self.scans[scan_id]
+        shape = self.volume(scan_id).shape
+        nodules = B.center2bbox(scan['coords'], scan['diameters'])
+        for _ in range(NEGATIVE_TRIALS):
+            center = self.rng.uniform(0, 1, 3) * shape
+            if not np.any(B.points_in_bboxes(center, nodules)):
+                break
+        return scan_id, center, 0
+
+    def fill(self, slot):
+        """
+        Sample a batch into a slot
+        """
+        patches = self.slots.patches[slot]
+        crops = self.buffer if self.augmentation else patches
+        for i in range(len(patches)):
+            scan_id, center, label = self.draw()
+            intensity.crop_normalize(self.volume(scan_id), B.center2bbox(center, self.patch_size),
+                                     self.v_min, self.v_max, out=crops[i, 0])
+            self.slots.labels[slot, i] = label
+        if self.augmentation:
+            image.augment_batch(crops, seed=self.rng, num_workers=1, out=patches, **self.augmentation)
+
+
+def _worker_loop(worker_id, free_slots, ready_slots, raw_patches, raw_labels, slots_shape, kwargs):
+    slots = _Slots(slots_shape[0], slots_shape[1], slots_shape[3], raw_patches, raw_labels)
+    worker = _Worker(slots=slots, **kwargs)
+    while True:
+        t = time.time()
+        slot = free_slots.get()
+        if slot is None:
+            break
+        idle = time.time() - t
+        t = time.time()
+        worker.fill(slot)
+        ready_slots.put((slot, worker_id, time.time() - t, idle))
+
+
+class PatchSampler(object):
+    """
+    Endless iterator of (patches, labels) batches sampled by worker processes
+    patches: (batch_size, 1, patch_size, patch_size, patch_size) float32 in [0, 1]
+    labels: (batch_size,) int8, 1 for the patches around a nodule, 0 for the random ones
+    """
+    def __init__(self, data_dir, label_dir, patch_size=32, batch_size=32, pos_fraction=0.5, jitter=4,
+                 v_min=-1024., v_max=800., augmentation=AUGMENTATION, num_workers=None, num_slots=None, seed=0):
+        """
+        :param data_dir: folder of the .npy volumes
+        :param label_dir: folder of the .npz labels, with nodule_voxel_coord and nodule_voxel_diameter
+        :param pos_fraction: probability of a positive patch
+        :param jitter: positive patches are centered up to jitter voxels away from the nodule center
+        :param v_min: lower bound of the window of normalize
+        :param v_max: upper bound of the window of normalize
+        :param augmentation: parameters of image.random_affine, None for no augmentation
+        :param num_workers: number of processes, cpu count if None
+        :param num_slots: number of batches in shared memory, NUM_SLOTS_PER_WORKER per worker if None
+        :param seed: seed of the workers, worker i is seeded with seed + i
+        """
+        self.scans = list_scans(data_dir, label_dir)
+        if not self.scans:
+            raise IOError('no labelled scan in %s' % data_dir)
+        self.num_workers = num_workers or cpu_count()
+        num_slots = num_slots or NUM_SLOTS_PER_WORKER * self.num_workers
+        self.slots = _Slots(num_slots, batch_size, patch_size)
+        self.kwargs = dict(scans=self.scans, patch_size=patch_size, pos_fraction=pos_fraction, jitter=jitter,
+                           v_min=v_min, v_max=v_max, augmentation=augmentation)
+        self.seed = seed
+        self.processes = []
+        self.current = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_batches = 0
+        self.wait = 0.
+        self.busy = np.zeros(self.num_workers)
+        self.idle = np.zeros(self.num_workers)
+        self.start_time = time.time()
+
+    def start(self):
+        self.free_slots, self.ready_slots = Queue(), Queue()
+        for slot in range(self.slots.shape[0]):
+            self.free_slots.put(slot)
+        for worker_id in range(self.num_workers):
+            kwargs = dict(self.kwargs, seed=self.seed + worker_id)
+            process = Process(target=_worker_loop, args=(worker_id, self.free_slots, self.ready_slots,
+                                                         self.slots.raw_patches, self.slots.raw_labels,
+                                                         self.slots.shape, kwargs))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.reset_stats()
+        return self
+
+    def close(self):
+        for _ in self.processes:
+            self.free_slots.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Next batch, the slot of the previous one is given back to the workers
+        :return: patches, labels, views of the shared memory valid until the next call
+        """
+        if self.current is not None:
+            self.free_slots.put(self.current)
+        t = time.time()
+        self.current, worker_id, busy, idle = self.ready_slots.get()
+        self.wait += time.time() - t
+        self.busy[worker_id] += busy
+        self.idle[worker_id] += idle
+        self.num_batches += 1
+        return self.slots.patches[self.current], self.slots.labels[self.current]
+
+    next = __next__  # python2
+
+    def stats(self):
+        """
+        :return: dict(patches_per_second, consumer_wait, worker_utilisation), the utilisation of a worker
+                 being the fraction of its time spent sampling rather than waiting for a free slot
+        """
+        elapsed = time.time() - self.start_time
+        return dict(patches_per_second=self.num_batches * self.slots.shape[1] / elapsed,
+                    consumer_wait=self.wait / elapsed,
+                    worker_utilisation=self.busy / np.maximum(self.busy + self.idle, 1e-9))
+
+    def report(self):
+        stats = self.stats()
+        utilisation = stats['worker_utilisation']
+        return '%.1f patches/s, consumer waiting %.0f%% of the time, worker utilisation mean %.0f%% min %.0f%%' \
+            % (stats['patches_per_second'], 100 * stats['consumer_wait'], 100 * np.mean(utilisation),
+               100 * np.min(utilisation))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput of the patch sampler')
+    parser.add_argument('data_dir', type=str)
+    parser.add_argument('label_dir', type=str)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--patch_size', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=100)
+    parser.add_argument('--step_time', type=float, default=0., help='simulated training step, in seconds')
+    parser.add_argument('--no_augmentation', action='store_true')
+    args = parser.parse_args()
+
+    sampler = PatchSampler(args.data_dir, args.label_dir, args.patch_size, args.batch_size,
+                           augmentation=None if args.no_augmentation else AUGMENTATION, num_workers=args.workers)
+    with sampler:
+        for num_batches, (patches, labels) in enumerate(sampler):
+            time.sleep(args.step_time)
+            if num_batches + 1 == args.batches:
+                break
+    print(sampler.report())
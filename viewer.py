@@ -7,17 +7,38 @@ Summary of available functions:
     vis_slice: 2D visualize for a slice
     vis_slices: 2D visualize for several slices
     view_scan: interactive 2D view for a volume
+    view_planes: interactive axial/coronal/sagittal view for a volume
+    window_slice: map a slice into uint8 for a window
 """
 
+import threading
+import time
+from collections import OrderedDict, deque
+
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
+from matplotlib.widgets import Slider
 
 import bbox as B
+import profiler
+from intensity import window_lut, window_slice
 
 FIG_SIZE = (9, 9)
 SCROLL_STEP = 1
 KEY_STEP = 4
+CACHE_SIZE = 256  # number of rendered slices kept by view_scan
+PREFETCH_SIZE = 8  # number of slices rendered ahead of the scroll by view_scan
+
+COPY_CHUNK = 16  # number of rows copied at once when building an axis-contiguous copy
+
+# window presets of view_scan, key: (low, high). 'o' is added as the range of the first slice
+WINDOW_PRESETS = {'f': (-1150., 350.), 'z': (-160., 220.)}
+
+# planes of a (y, x, z) volume: (slice axis, row axis, column axis)
+AXIAL = (2, 0, 1)
+CORONAL = (0, 2, 1)
+SAGITTAL = (1, 2, 0)
 
 
 def vis_slice(slice, bbox_list=(), title=None, path=None, color=False, figsize=FIG_SIZE):
@@ -94,26 +115,367 @@ def vis_slices(slices, ncols=3, nrows=None, title=None, path=None, color=False,
 
     plt.close(fig)
 
-def sagittal(bbox, shape):
-    sagibbox = [bbox[0], bbox[2]*shape[0]/shape[2], bbox[1], bbox[3], bbox[5]*shape[0]/shape[2], bbox[4]]
-    return sagibbox
+
+class SliceCache(object):
+    """
+    Bounded LRU cache of rendered slices, shared with the prefetching thread
+    """
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+class SlicePrefetcher(object):
+    """
+    Background thread rendering the next slices in the scroll direction into the cache of view_scan,
+    so that the UI thread only swaps arrays. The direction and the stride are predicted from the recent moves.
+    """
+    def __init__(self, render, num_slices, size=PREFETCH_SIZE, max_stride=KEY_STEP):
+        """
+        :param render: render(axis, index, window), rendering a slice into the cache
+        :param num_slices: dict of axis -> number of slices
+        :param size: number of slices to prefetch
+        :param max_stride: max stride between prefetched slices, larger moves are jumps
+        """
+        self.render = render
+        self.num_slices = num_slices
+        self.size = size
+        self.max_stride = max_stride
+        self.moves = deque(maxlen=4)
+        self.axis = None
+        self.request = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def hint(self, axis, index, step, window):
+        """
+        Tell the prefetcher that slice index along axis is displayed, after a move of step slices
+        """
+        if axis != self.axis:
+            self.axis = axis
+            self.moves.clear()
+        if step != 0:
+            self.moves.append(step)
+        if not self.moves:
+            return
+        direction = 1 if sum(self.moves) >= 0 else -1
+        stride = max(1, min(abs(self.moves[-1]), self.max_stride))
+        with self.condition:
+            self.request = (axis, index, direction * stride, window)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.request is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                axis, index, stride, window = self.request
+                self.request = None
+
+            for i in range(1, self.size + 1):
+                # a newer request makes the remaining slices useless
+                if self.request is not None or self.stopped:
+                    break
+                next_index = index + i * stride
+                if not 0 <= next_index < self.num_slices[axis]:
+                    break
+                self.render(axis, next_index, window)
+
+
+class FrameTimer(object):
+    """
+    Durations of the last redraws of view_scan
+    """
+    def __init__(self, size=100):
+        self.times = deque(maxlen=size)
+
+    def add(self, duration):
+        self.times.append(duration)
+
+    def summary(self):
+        if not self.times:
+            return 'no frame'
+        times = 1000. * np.array(self.times)
+        return 'frames: %d, mean: %.1fms, median: %.1fms, max: %.1fms' % (
+            len(times), np.mean(times), np.median(times), np.max(times))
+
+
+class SliceIndex(object):
+    """
+    Index of the bounding boxes intersecting each slice along an axis, so that a redraw only
+    touches the boxes of the displayed slice. Box i is in slice s if bbox[axis] <= s < bbox[axis + 3].
+    """
+    def __init__(self, bbox_list, axis, num_slices, conf_list=None):
+        bboxes = np.array(bbox_list, dtype=np.int64).reshape((-1, 6))
+        low = np.clip(bboxes[:, axis], 0, num_slices)
+        high = np.clip(bboxes[:, axis + 3], 0, num_slices)
+        lengths = np.maximum(high - low, 0)
+        starts = np.cumsum(lengths) - lengths
+
+        # one entry per (box, slice) pair, sorted by slice
+        ids = np.repeat(np.arange(len(bboxes)), lengths)
+        slices = np.repeat(low - starts, lengths) + np.arange(np.sum(lengths))
+        order = np.argsort(slices, kind='mergesort')
+        self.ids = ids[order]
+        self.offsets = np.searchsorted(slices[order], np.arange(num_slices + 1))
+
+        self.conf = None
+        if conf_list is not None:
+            self.conf = np.array([np.inf if conf is None else conf for conf in conf_list], dtype=np.float64)
+
+    def query(self, index, conf_threshold=None):
+        """
+        :param index: slice index
+        :param conf_threshold: optional, only the boxes with a confidence >= conf_threshold are returned
+        :return: ids of the boxes intersecting the slice
+        """
+        if not 0 <= index < len(self.offsets) - 1:
+            return self.ids[0:0]
+        ids = self.ids[self.offsets[index]:self.offsets[index + 1]]
+        if conf_threshold is not None and self.conf is not None:
+            ids = ids[self.conf[ids] >= conf_threshold]
+        return ids
 
 
-def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0, color=False, figsize=FIG_SIZE, patientName = None):
+class PlaneLayout(object):
+    """
+    Slices of a volume along each axis. If contiguous, the first access to an axis starts building,
+    in the background, a copy of the volume with that axis first, so that its slices are then read
+    from contiguous memory. Until the copy is ready, slices are read from the volume itself.
+    """
+    def __init__(self, vol, contiguous=True):
+        self.vol = vol
+        self.contiguous = contiguous
+        self.copies = dict()
+        self.building = set()
+        self.lock = threading.Lock()
+
+    def slice(self, axis, index):
+        """
+        :return: 2D slice, the two other axes are kept in their order
+        """
+        copy = self.copies.get(axis)
+        if copy is not None:
+            return copy[index]
+        if self.contiguous:
+            self._build(axis)
+        return self.vol[(slice(None),) * axis + (index,)]
+
+    def _build(self, axis):
+        with self.lock:
+            if axis in self.building:
+                return
+            self.building.add(axis)
+
+        view = np.moveaxis(self.vol, axis, 0)
+        if isinstance(view, np.ndarray) and view[0].flags['C_CONTIGUOUS']:
+            self.copies[axis] = view
+            return
+        thread = threading.Thread(target=self._copy, args=(axis,))
+        thread.daemon = True
+        thread.start()
+
+    def _copy(self, axis):
+        shape = (self.vol.shape[axis],) + tuple(n for dim, n in enumerate(self.vol.shape) if dim != axis)
+        copy = np.empty(shape, dtype=self.vol.dtype)
+        # read the volume by chunks of its first axis, i.e. sequentially for a C-ordered memory map
+        target = np.moveaxis(copy, 0, axis)
+        for start in range(0, self.vol.shape[0], COPY_CHUNK):
+            target[start:start + COPY_CHUNK] = self.vol[start:start + COPY_CHUNK]
+        self.copies[axis] = copy
+
+
+class BoxPool(object):
+    """
+    Pooled (Rectangle, annotation) pairs of an axes, updated in place instead of created on every redraw
+    """
+    def __init__(self, ax, animated=False):
+        self.ax = ax
+        self.animated = animated
+        self.pairs = list()
+        self.num_visible = 0
+
+    def update(self, boxes, ids, color_list=None, attr_list=None):
+        """
+        Show the boxes ids, hide the other pooled artists
+        :param boxes: boxes projected on the plane, see project_bbox
+        :param ids: ids of the boxes to show
+        """
+        while len(self.pairs) < len(ids):
+            rect = Rectangle((0, 0), 1, 1, fill=False, linewidth=1, animated=self.animated)
+            self.ax.add_patch(rect)
+            self.pairs.append((rect, self.ax.annotate('', xy=(0, 0), animated=self.animated)))
+
+        for (rect, anno), bbox_id in zip(self.pairs, ids):
+            bbox = boxes[bbox_id]
+            if not color_list:
+                color_now = 'yellow'
+            else:
+                color_now = color_list[bbox_id]
+            rect.set_xy((bbox[1] - 1, bbox[0] - 1))
+            rect.set_width(bbox[4] - bbox[1] + 1)
+            rect.set_height(bbox[3] - bbox[0] + 1)
+            rect.set_edgecolor(color_now)
+
+            text = '%d:' % bbox_id
+            if attr_list is not None:
+                text = text + str(attr_list[bbox_id])
+            anno.set_text(text)
+            anno.xy = anno.xyann = (bbox[4] + 5, bbox[3] + 5)
+            anno.set_color(color_now)
+
+        self.num_visible = len(ids)
+        for ind, (rect, anno) in enumerate(self.pairs):
+            rect.set_visible(ind < len(ids))
+            anno.set_visible(ind < len(ids))
+
+    def artists(self):
+        return [artist for pair in self.pairs[:self.num_visible] for artist in pair]
+
+
+class Blitter(object):
+    """
+    Repaint only the animated artists of a figure over a background cached after each full draw.
+    Falls back to full redraws if disabled or not supported by the backend.
+    """
+    def __init__(self, fig, animated_artists, enabled=True):
+        """
+        :param fig: figure
+        :param animated_artists: function returning the list of artists to repaint
+        :param enabled: whether to blit
+        """
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.animated_artists = animated_artists
+        self.enabled = enabled and getattr(self.canvas, 'supports_blit', False)
+        self.background = None
+        if self.enabled:
+            self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        # a full draw leaves out the animated artists, keep it as the background
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for artist in self.animated_artists():
+            self.fig.draw_artist(artist)
+
+    def refresh(self, full=False):
+        """
+        :param full: redraw the whole figure, e.g. after changing the axes limits
+        """
+        if self.enabled and self.background is not None and not full:
+            self.canvas.restore_region(self.background)
+            self.draw_animated()
+            self.canvas.blit(self.fig.bbox)
+            self.canvas.flush_events()
+        else:
+            self.canvas.draw()
+
+
+def project_bbox(bbox, plane):
+    """
+    Project a bounding box of the volume onto a plane. Both are in voxels, so that the projection
+    is exact whatever the spacing, which is taken into account by the aspect of the display.
+    :param bbox: (6,) bounding box of the volume
+    :param plane: (slice axis, row axis, column axis)
+    :return: [min_row, min_col, min_slice, max_row, max_col, max_slice]
+    """
+    axis, row, col = plane
+    return [bbox[row], bbox[col], bbox[axis], bbox[row + 3], bbox[col + 3], bbox[axis + 3]]
+
+
+def plane_aspect(spacing, plane):
+    """
+    Aspect of a plane for imshow, so that it is displayed in physical proportions
+    """
+    if spacing is None:
+        return 1.
+    return float(spacing[plane[1]]) / float(spacing[plane[2]])
+
+
+def plane_image(layout, plane, index):
+    """
+    Slice of a plane, with the row axis first
+    """
+    image = layout.slice(plane[0], index)
+    if plane[1] > plane[2]:
+        image = image.T
+    return image
+
+
+def initial_presets(vol, start_slice, window_presets=None):
+    """
+    WINDOW_PRESETS with 'o', the range of an axial slice, and window_presets
+    """
+    # For label, the slice might be constant
+    if np.max(vol[:, :, start_slice]) == np.min(vol[:, :, start_slice]):
+        lowlevel, highlevel = np.min(vol), np.max(vol)
+    else:
+        lowlevel, highlevel = np.min(vol[:, :, start_slice]), np.max(vol[:, :, start_slice])
+    presets = dict(WINDOW_PRESETS)
+    presets['o'] = (float(lowlevel), float(max(highlevel, lowlevel + 1)))
+    presets.update(window_presets or {})
+    return presets
+
+
+def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0, color=False, figsize=FIG_SIZE, patientName = None,
+              window_presets=None, cache_size=CACHE_SIZE, conf_list=None, conf_threshold=0., blit=True,
+              frame_timer=None, prefetch=PREFETCH_SIZE, spacing=None, contiguous=None):
     """
     Interactive view a volume
     Keyboard Mapping:
-    w-next slice; z-previous slice;
+    w-next slice; x-previous slice;
     d-next bbox; a-previous bbox;
+    f, z, o or a key of window_presets- window;
+    b-toggle bboxes; t-print frame times, and the stages of profiler if enabled;
     mouse scroll- 5 slices to forward or backward
-    :param vol: 3D numpy array
+    :param vol: 3D numpy array of any real dtype, e.g. int16 HU. Slices are rendered into uint8 and cached
     :param bbox_list: a list of bounding box
     :param attr_list: optional. If not None, it must be of same length of bbox_list
+    :param conf_list: optional, confidence of each box, None for boxes always displayed, e.g. labels.
+                      If not None, a slider filters the boxes by confidence
+    :param conf_threshold: initial value of the confidence slider
     :param start_slice: first slice to display
     :param color:
+    :param window_presets: optional, dict of key: (low, high) adding to or overriding WINDOW_PRESETS
+    :param cache_size: number of rendered slices to cache
+    :param blit: repaint only the image and the boxes over a cached background, if the backend supports it
+    :param frame_timer: optional FrameTimer recording the duration of each redraw, printed with key t
+    :param prefetch: number of slices rendered ahead of the scroll by a background thread, 0 to disable.
+                     Useful for memory-mapped volumes
+    :param spacing: optional, (3,) voxel spacing, planes are then displayed in physical proportions
+    :param contiguous: read the slices from axis-contiguous copies of vol built in the background, see PlaneLayout.
+                       If None, only for memory-mapped volumes
     :return:
     """
-    global cur_slice, bbox_flag, cur_bbox, windows, lowlevel, highlevel, sagittal_Cur_slice, bs, shape, patientID
+    global cur_slice, bbox_flag, cur_bbox, windows, sagittal_Cur_slice, bs, shape, patientID
 
     bbox_flag = True  # whether to display bounding boxes
     cur_bbox = None  # current bounding box index
@@ -126,24 +488,40 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
 
     fig = plt.figure(figsize=figsize)
 
-    # It seems plt would adjust the range of color by the first displayed image.
-    # Thus, for label, we might display a nonzero slice first.
-    if np.max(vol[:, :, cur_slice]) == np.min(vol[:, :, cur_slice]):
-        slice = np.random.uniform(np.min(vol), np.max(vol), size=(vol.shape[0], vol.shape[1]))
-    else:
-        slice = vol[:, :, cur_slice]
-    if color:
-
-        im = plt.imshow(slice)
-    else:
-        lowlevel = np.min(slice)
-        highlevel = np.max(slice)
-        slice = (slice + 1150) * (slice + 1150 > 0)
-        slice = (slice >= 1500) * 1500 + slice * (slice < 1500)
-        slice = slice / 1500 * (highlevel - lowlevel) + lowlevel
-        im = plt.imshow(slice, cmap=plt.cm.gray)
+    presets = initial_presets(vol, cur_slice, window_presets)
+    luts = dict()
+    cache = SliceCache(cache_size)
+    if contiguous is None:
+        contiguous = isinstance(vol, np.memmap)
+    layout = PlaneLayout(vol, contiguous)
+    planes = {2: (2, 0, 1), 1: (1, 0, 2)}  # axial and sagittal (y rows, z columns) planes of view_scan
+    if frame_timer is None:
+        frame_timer = FrameTimer()
+
+    def render(axis, index, window):
+        """
+        Window a slice along axis into uint8, served from the cache when possible
+        """
+        key = (axis, index, window)
+        imSlice = cache.get(key)
+        if imSlice is None:
+            profiler.count('view_scan.cache_miss')
+            with profiler.timer('view_scan.render'):
+                low, high = presets[window]
+                if window not in luts:
+                    luts[window] = window_lut(low, high, vol.dtype)
+                imSlice = window_slice(np.asarray(plane_image(layout, planes[axis], index)), low, high,
+                                       luts[window])
+            cache.put(key, imSlice)
+        return imSlice
+
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = SlicePrefetcher(render, {1: vol.shape[1], 2: vol.shape[2]}, prefetch)
+
+    im = plt.imshow(render(2, cur_slice, windows), cmap=None if color else plt.cm.gray, vmin=0, vmax=255,
+                    interpolation='nearest', aspect=plane_aspect(spacing, planes[2]))
     plt.axis('off')
-    plt.axis('equal')
     # height, width = slice.shape
     # fig.set_size_inches(width / 100.0 / 3.0, height / 100.0 / 3.0)
     # plt.gca().xaxis.set_major_locator(plt.NullLocator())
@@ -153,57 +531,63 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
     ax = plt.gca()
     ax.set_title('patientID=%s, z=%d' %(patientID, cur_slice))
 
-    artists = list()
     bbox_list = [B.regularize(bbox) for bbox in bbox_list]
-    vbbox_list = [B.regularize(sagittal(bbox, vol.shape)) for bbox in bbox_list]
+    vbbox_list = [project_bbox(bbox, planes[1]) for bbox in bbox_list]
+    # boxes intersecting each slice, built once for each viewing axis
+    axial_index = SliceIndex(bbox_list, 2, vol.shape[2], conf_list)
+    sagittal_index = SliceIndex(vbbox_list, 2, vol.shape[1], conf_list)
+
+    slider = None
+    if conf_list is not None and np.any(np.isfinite(axial_index.conf)):
+        finite_conf = axial_index.conf[np.isfinite(axial_index.conf)]
+        slider = Slider(fig.add_axes([0.25, 0.02, 0.5, 0.02]), 'confidence',
+                        np.min(finite_conf), np.max(finite_conf), valinit=conf_threshold)
+        slider.on_changed(lambda val: show(cur_slice) if bs == '.' else sagittalShow(sagittal_Cur_slice))
+        plt.sca(ax)
+
+    def current_threshold():
+        return None if slider is None else slider.val
+
+    blitter = Blitter(fig, lambda: [im, ax.title] + pool.artists(), blit)
+    im.set_animated(blitter.enabled)
+    ax.title.set_animated(blitter.enabled)
+    pool = BoxPool(ax, animated=blitter.enabled)
+    displayed = dict(axis=2)
+
+    @profiler.timed('view_scan.update')
+    def update(axis, index, step, boxes, index_of_boxes, title):
+        """
+        Display the slice index along axis with its boxes
+        """
+        start = time.time()
+        im.set_array(render(axis, index, windows))
+        if prefetcher is not None:
+            prefetcher.hint(axis, index, step, windows)
+        ax.set_title(title)
+        pool.update(boxes, index_of_boxes.query(index, current_threshold()) if bbox_flag else [],
+                    color_list, attr_list)
+
+        # switching plane changes the extent of the image, the whole figure is redrawn
+        full = displayed['axis'] != axis
+        if full:
+            displayed['axis'] = axis
+            rows, cols = vol.shape[planes[axis][1]], vol.shape[planes[axis][2]]
+            im.set_extent((-0.5, cols - 0.5, rows - 0.5, -0.5))
+            ax.set_xlim(-0.5, cols - 0.5)
+            ax.set_ylim(rows - 0.5, -0.5)
+            ax.set_aspect(plane_aspect(spacing, planes[axis]))
+        with profiler.timer('view_scan.draw'):
+            blitter.refresh(full)
+        frame_timer.add(time.time() - start)
 
     def sagittalShow(next_slice):
-        global sagittal_Cur_slice, lowlevel, highlevel, bs,bbox_flag, cur_bbox, windows
-
-        next_slice = int(next_slice)
-        sagittal_Cur_slice = max(0, min(vol.shape[1] - 1, next_slice))
-        imSlice = vol[:,sagittal_Cur_slice,:]
-        if windows == "f":
-
-            # imSlice = (imSlice>=-1150)*imSlice + (imSlice<-1150)*(-1150)
-            # imSlice = (imSlice<=350)*imSlice + (imSlice>350)* 350
-            # imSlice = (imSlice - (-1150))/1500*(highlevel - lowlevel) + lowlevel
-            imSlice = (imSlice + 1150)*(imSlice + 1150> 0)
-            imSlice = (imSlice >= 1500) * 1500 + imSlice*(imSlice < 1500)
-            imSlice = imSlice/ 1500 * (highlevel - lowlevel) + lowlevel
-        elif windows == 'z':
-            imSlice = (imSlice + 160)*(imSlice + 160> 0)
-            imSlice = (imSlice >= 380) * 380 + imSlice*(imSlice < 380)
-            imSlice = imSlice/ 380 * (highlevel - lowlevel) + lowlevel
-        elif windows == "o":
-            pass
-
-        im.set_array(imSlice)
-        ax.set_title('patientID=%s, y=%d' % (patientID, sagittal_Cur_slice))
-        for artist in artists:
-            artist.remove()
-        del artists[:]
-
-        if bbox_flag:
-            for bbox_id, bbox in enumerate(vbbox_list):
-                bbox = (np.round(bbox)).astype(np.int16)
-                if not color_list:
-                    color_now = 'yellow'
-                else:
-                    color_now = color_list[bbox_id]
-                if bbox[2] <= sagittal_Cur_slice < bbox[5]:
-                    rect = Rectangle((bbox[1] - 1, bbox[0] - 1), bbox[4] - bbox[1] + 1, bbox[3] - bbox[0] + 1,
-                                     fill=False, color=color_now, linewidth=1)
-                    ax.add_patch(rect)
-                    artists.append(rect)
-
-                    anno = '%d:' % bbox_id
-                    if attr_list is not None:
-                        anno = anno + str(attr_list[bbox_id])
-                    artists.append(ax.annotate(anno, xy=(bbox[4] + 5, bbox[3] + 5), color=color_now))
-
-        plt.draw()
+        global sagittal_Cur_slice, bs,bbox_flag, cur_bbox, windows
 
+        next_slice = max(0, min(vol.shape[1] - 1, int(next_slice)))
+        step = next_slice - int(sagittal_Cur_slice)
+        sagittal_Cur_slice = next_slice
+        update(1, sagittal_Cur_slice, step, vbbox_list, sagittal_index,
+               'patientID=%s, x=%d' % (patientID, sagittal_Cur_slice))
 
     def show(next_slice):
         """
@@ -211,58 +595,18 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
         :param next_slice: next slice to display, which will be assigned to cur slice
         :return: None
         """
-        global cur_slice, bbox_flag, cur_bbox, windows, lowlevel, highlevel, bs
+        global cur_slice, bbox_flag, cur_bbox, windows, bs
 
-        next_slice = int(next_slice)
-        cur_slice = max(0, min(vol.shape[2] - 1, next_slice))
+        next_slice = max(0, min(vol.shape[2] - 1, int(next_slice)))
+        step = next_slice - int(cur_slice)
+        cur_slice = next_slice
         # print 'show: cur_slice=', cur_slice
         # print 'show: bbox_flag=', bbox_flag
         # print 'show: cur_bbox=', cur_bbox
-        imSlice = vol[:, :, cur_slice]
-        if windows == "f":
-
-            # imSlice = (imSlice>=-1150)*imSlice + (imSlice<-1150)*(-1150)
-            # imSlice = (imSlice<=350)*imSlice + (imSlice>350)* 350
-            # imSlice = (imSlice - (-1150))/1500*(highlevel - lowlevel) + lowlevel
-            imSlice = (imSlice + 1150)*(imSlice + 1150> 0)
-            imSlice = (imSlice >= 1500) * 1500 + imSlice*(imSlice < 1500)
-            imSlice = imSlice/ 1500 * (highlevel - lowlevel) + lowlevel
-        elif windows == 'z':
-            imSlice = (imSlice + 160)*(imSlice + 160> 0)
-            imSlice = (imSlice >= 380) * 380 + imSlice*(imSlice < 380)
-            imSlice = imSlice/ 380 * (highlevel - lowlevel) + lowlevel
-        elif windows == "o":
-            pass
-        im.set_array(imSlice)
-        ax.set_title('patientID=%s, z=%d' %(patientID, cur_slice))
-
-        # clear bbox
-        for artist in artists:
-            artist.remove()
-        del artists[:]
-
-        if bbox_flag:
-            for bbox_id, bbox in enumerate(bbox_list):
-                bbox = (np.round(bbox)).astype(np.int16)
-                if not color_list:
-                    color_now = 'yellow'
-                else:
-                    color_now = color_list[bbox_id]
-                if bbox[2] <= cur_slice < bbox[5]:
-                    rect = Rectangle((bbox[1] - 1, bbox[0] - 1), bbox[4] - bbox[1] + 1, bbox[3] - bbox[0] + 1,
-                                     fill=False, color=color_now, linewidth=1)
-                    ax.add_patch(rect)
-                    artists.append(rect)
-
-                    anno = '%d:' % bbox_id
-                    if attr_list is not None:
-                        anno = anno + str(attr_list[bbox_id])
-                    artists.append(ax.annotate(anno, xy=(bbox[4] + 5, bbox[3] + 5), color=color_now))
-
-        plt.draw()  # python2 plt.draw() works while python3 fig.show() works
+        update(2, cur_slice, step, bbox_list, axial_index, 'patientID=%s, z=%d' %(patientID, cur_slice))
 
+    @profiler.timed('view_scan.on_scroll')
     def on_scroll(event):
-        print(SCROLL_STEP)
         if bs == ',':
             sagittalShow(sagittal_Cur_slice + event.step * SCROLL_STEP)
         elif bs == '.':
@@ -276,18 +620,16 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
             # sagittalShow(sagittal_Cur_slice)
         if bs == ',':
             (posX, posZ) = plt.ginput()[0]
-            cur_slice = posX*shape[2]/shape[0]
+            cur_slice = posX
             # show(cur_slice)
-        print(posX)
 
 
 
+    @profiler.timed('view_scan.on_press')
     def on_press(event):
-        print(event.key)
         global cur_slice, bbox_flag, cur_bbox, windows, bs, sagittal_Cur_slice, shape
 
         if event.key == "x":
-            print(KEY_STEP)
             show(cur_slice - KEY_STEP)
         elif event.key == "w":
             show(cur_slice + KEY_STEP)
@@ -305,24 +647,10 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
         elif event.key == "b":
             bbox_flag = not bbox_flag
             show(cur_slice)
-        elif event.key == "f":
-            windows = 'f'
-            if bs == '.':
-                show(cur_slice)
-            elif bs ==',':
-                sagittalShow(sagittal_Cur_slice)
-        elif event.key == "z":
-            windows = 'z'
-            if bs == '.':
-                show(cur_slice)
-            elif bs ==',':
-                sagittalShow(sagittal_Cur_slice)
-        elif event.key == "o":
-            windows = 'o'
-            if bs == '.':
-                show(cur_slice)
-            elif bs ==',':
-                sagittalShow(sagittal_Cur_slice)
+        elif event.key == "t":
+            print(frame_timer.summary())
+            if profiler.is_enabled():
+                print(profiler.summary())
         elif event.key == ",":
             if bs != ',':
                 (posY, posX)= plt.ginput()[0]
@@ -333,9 +661,15 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
         elif event.key == ".":
             if bs != '.':
                 (posX, posZ) = plt.ginput()[0]
-                cur_slice = posX*shape[2]/shape[0]
+                cur_slice = posX
             bs = '.'
             show(cur_slice)
+        elif event.key in presets:
+            windows = event.key
+            if bs == '.':
+                show(cur_slice)
+            elif bs == ',':
+                sagittalShow(sagittal_Cur_slice)
 
 
 
@@ -345,6 +679,146 @@ def view_scan(vol, bbox_list=(), attr_list=None, color_list=None, start_slice=0,
     fig.canvas.mpl_connect('key_press_event', on_press)
     # fig.canvas.mpl_connect('button_release_event', button_release)
     plt.show()
+    if prefetcher is not None:
+        prefetcher.stop()
+    plt.close(fig)
+
+
+def view_planes(vol, bbox_list=(), attr_list=None, color_list=None, spacing=None, start=None, color=False,
+                figsize=(18, 7), window_presets=None, cache_size=CACHE_SIZE, contiguous=None, blit=True,
+                frame_timer=None):
+    """
+    Interactive multi-planar view of a (y, x, z) volume: axial, coronal and sagittal planes with linked crosshairs
+    Keyboard/Mouse Mapping:
+    click- move the crosshairs to the clicked voxel;
+    mouse scroll- move the slice of the plane under the mouse;
+    w-next slice; x-previous slice, of the plane under the mouse;
+    f, z, o or a key of window_presets- window;
+    b-toggle bboxes; t-print frame times, and the stages of profiler if enabled;
+    :param vol: 3D numpy array, (y, x, z)
+    :param bbox_list: a list of bounding box, in voxels of vol
+    :param attr_list: optional. If not None, it must be of same length of bbox_list
+    :param color_list: optional. If not None, it must be of same length of bbox_list
+    :param spacing: optional, (3,) voxel spacing, planes are then displayed in physical proportions
+    :param start: (3,) voxel of the crosshairs at start, center of the volume if None
+    :param color:
+    :param window_presets: optional, dict of key: (low, high) adding to or overriding WINDOW_PRESETS
+    :param cache_size: number of rendered slices to cache
+    :param contiguous: read every plane from an axis-contiguous copy of vol built in the background,
+                       see PlaneLayout. If None, only for memory-mapped volumes
+    :param blit: repaint only the images and the overlays, if the backend supports it
+    :param frame_timer: optional FrameTimer recording the duration of each redraw
+    :return:
+    """
+    cursor = [int(n // 2) for n in vol.shape] if start is None else [int(round(v)) for v in start]
+    state = dict(window='f', bbox_flag=True)
+    presets = initial_presets(vol, cursor[2], window_presets)
+    luts = dict()
+    cache = SliceCache(cache_size)
+    if contiguous is None:
+        contiguous = isinstance(vol, np.memmap)
+    layout = PlaneLayout(vol, contiguous)
+    if frame_timer is None:
+        frame_timer = FrameTimer()
+
+    def render(plane, index, window):
+        key = (plane, index, window)
+        image = cache.get(key)
+        if image is None:
+            profiler.count('view_planes.cache_miss')
+            with profiler.timer('view_planes.render'):
+                low, high = presets[window]
+                if window not in luts:
+                    luts[window] = window_lut(low, high, vol.dtype)
+                image = window_slice(np.asarray(plane_image(layout, plane, index)), low, high, luts[window])
+            cache.put(key, image)
+        return image
+
+    fig, axes = plt.subplots(1, 3, figsize=figsize)
+    panes = list()
+    blitter = Blitter(fig, lambda: [artist for pane in panes for artist in pane['artists']()], blit)
+    bbox_list = [B.regularize(bbox) for bbox in bbox_list]
+    for ax, plane, name in zip(axes, [AXIAL, CORONAL, SAGITTAL], ['axial', 'coronal', 'sagittal']):
+        axis, row, col = plane
+        im = ax.imshow(render(plane, cursor[axis], state['window']), cmap=None if color else plt.cm.gray,
+                       vmin=0, vmax=255, interpolation='nearest', aspect=plane_aspect(spacing, plane),
+                       animated=blitter.enabled)
+        ax.axis('off')
+        ax.title.set_animated(blitter.enabled)
+        boxes = [project_bbox(bbox, plane) for bbox in bbox_list]
+        pane = dict(ax=ax, plane=plane, name=name, im=im, boxes=boxes,
+                    index=SliceIndex(boxes, 2, vol.shape[axis]),
+                    pool=BoxPool(ax, animated=blitter.enabled),
+                    hline=ax.axhline(cursor[row], color='cyan', linewidth=0.5, animated=blitter.enabled),
+                    vline=ax.axvline(cursor[col], color='cyan', linewidth=0.5, animated=blitter.enabled))
+        pane['artists'] = (lambda pane: lambda: [pane['im'], pane['ax'].title, pane['hline'], pane['vline']] +
+                           pane['pool'].artists())(pane)
+        panes.append(pane)
+
+    @profiler.timed('view_planes.update')
+    def update():
+        start_time = time.time()
+        for pane in panes:
+            axis, row, col = pane['plane']
+            pane['im'].set_array(render(pane['plane'], cursor[axis], state['window']))
+            pane['ax'].set_title('%s %s=%d' % (pane['name'], 'yxz'[axis], cursor[axis]))
+            pane['hline'].set_ydata([cursor[row], cursor[row]])
+            pane['vline'].set_xdata([cursor[col], cursor[col]])
+            ids = pane['index'].query(cursor[axis]) if state['bbox_flag'] else []
+            pane['pool'].update(pane['boxes'], ids, color_list, attr_list)
+        with profiler.timer('view_planes.draw'):
+            blitter.refresh()
+        frame_timer.add(time.time() - start_time)
+
+    def move(axis, step):
+        cursor[axis] = max(0, min(vol.shape[axis] - 1, cursor[axis] + step))
+        update()
+
+    def pane_of(event):
+        for pane in panes:
+            if event.inaxes is pane['ax']:
+                return pane
+        return None
+
+    @profiler.timed('view_planes.on_click')
+    def on_click(event):
+        pane = pane_of(event)
+        if pane is None or event.button != 1 or event.xdata is None:
+            return
+        axis, row, col = pane['plane']
+        cursor[row] = max(0, min(vol.shape[row] - 1, int(round(event.ydata))))
+        cursor[col] = max(0, min(vol.shape[col] - 1, int(round(event.xdata))))
+        update()
+
+    @profiler.timed('view_planes.on_scroll')
+    def on_scroll(event):
+        pane = pane_of(event)
+        if pane is not None:
+            move(pane['plane'][0], int(event.step * SCROLL_STEP))
+
+    @profiler.timed('view_planes.on_press')
+    def on_press(event):
+        pane = pane_of(event) or panes[0]
+        if event.key == 'w':
+            move(pane['plane'][0], KEY_STEP)
+        elif event.key == 'x':
+            move(pane['plane'][0], -KEY_STEP)
+        elif event.key == 'b':
+            state['bbox_flag'] = not state['bbox_flag']
+            update()
+        elif event.key == 't':
+            print(frame_timer.summary())
+            if profiler.is_enabled():
+                print(profiler.summary())
+        elif event.key in presets:
+            state['window'] = event.key
+            update()
+
+    update()
+    fig.canvas.mpl_connect('button_press_event', on_click)
+    fig.canvas.mpl_connect('scroll_event', on_scroll)
+    fig.canvas.mpl_connect('key_press_event', on_press)
+    plt.show()
     plt.close(fig)
 
 